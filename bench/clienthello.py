@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+
+# Runs the ClientHello parser over the corpus in bench/clienthello/, checks that it gets the same result no matter how
+# the data is split up, fuzzes it with truncated & mutated copies, and measures how long parsing takes.
+# New samples can be captured with --capture PORT, by pointing a client at that port, ex. curl https://localhost:PORT/
+# The corpus has ClientHellos of python, openssl s_client and curl. The -fragmented and -large-split samples are made from
+# those by splitting them into several records, and padding one to the size of a ClientHello with a post-quantum key share.
+
+import os, sys, time, random
+import argparse, socket
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+import clienthello
+
+corpus = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'clienthello')
+
+
+def load():
+  for name in sorted(os.listdir(corpus)):
+    if name.endswith('.bin'):
+      with open(os.path.join(corpus, name), 'rb') as f:
+        yield name[:-4], f.read()
+
+
+def describe(hello):
+  return (hello.sni, tuple(hello.alpn), tuple(hello.versions), hello.length)
+
+
+# Feeds the data in pieces of the given size, like it would arrive from the socket. Returns the result & number of recvs.
+def incremental(data, size):
+  buf = b''
+  recvs = 0
+  while True:
+    hello = clienthello.parse(buf)
+    if hello:
+      return hello, recvs
+    assert len(buf) < len(data), 'Incomplete ClientHello'
+    buf += data[len(buf):len(buf)+size]
+    recvs += 1
+
+
+def fuzz(data, rounds, rng):
+  outcomes = {'ok': 0, 'incomplete': 0, 'invalid': 0}
+  for i in range(rounds):
+    d = bytearray(data)
+    kind = rng.randrange(3)
+    if kind == 0:
+      d = d[:rng.randrange(len(d))]
+    elif kind == 1:
+      for j in range(rng.randrange(1, 4)):
+        d[rng.randrange(len(d))] = rng.randrange(256)
+    else:
+      pos = rng.randrange(len(d))
+      d[pos:pos] = rng.randbytes(rng.randrange(1, 16))
+    try:
+      outcomes['ok' if clienthello.parse(bytes(d)) else 'incomplete'] += 1
+    except ValueError:
+      outcomes['invalid'] += 1
+  return outcomes
+
+
+def capture(port, name):
+  with socket.create_server(('127.0.0.1', port)) as server:
+    print(f'Waiting for a ClientHello on port {port}')
+    conn, addr = server.accept()
+    with conn:
+      data = b''
+      while not clienthello.parse(data):
+        res = conn.recv(clienthello.RECV_SIZE)
+        if not res:
+          sys.exit('Connection closed before the end of the ClientHello')
+        data += res
+  hello = clienthello.parse(data)
+  with open(os.path.join(corpus, name + '.bin'), 'wb') as f:
+    f.write(data[:hello.length])
+  print(name, *describe(hello))
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='ClientHello parser corpus check, fuzzer & benchmark', formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+  parser.add_argument('-n', '--iterations', type=int, default=10000, help='number of times to parse each sample for the benchmark')
+  parser.add_argument('-f', '--fuzz', type=int, default=10000, help='number of mutated copies to parse per sample')
+  parser.add_argument('--seed', type=int, default=0, help='seed for the fuzzer')
+  parser.add_argument('--capture', type=int, metavar='PORT', help='save the ClientHello of a client connecting to PORT to the corpus')
+  parser.add_argument('--name', default='captured', help='name of the captured sample')
+  args = parser.parse_args()
+  if args.capture:
+    capture(args.capture, args.name)
+    sys.exit()
+  rng = random.Random(args.seed)
+  print(f'{"sample":<28} {"bytes":>6} {"recvs":>6} {"us/parse":>9}  sni, alpn, versions')
+  for name, data in load():
+    hello, recvs = incremental(data, clienthello.RECV_SIZE)
+    expected = describe(hello)
+    for size in (1, 2, 3, 7, 64, 512):
+      assert describe(incremental(data, size)[0]) == expected, (name, size)
+    outcomes = fuzz(data, args.fuzz, rng)
+    start = time.perf_counter()
+    for i in range(args.iterations):
+      clienthello.parse(data)
+    us = (time.perf_counter() - start) / args.iterations * 1e6
+    print(f'{name:<28} {len(data):>6} {recvs:>6} {us:>9.1f}  {hello.sni}, {",".join(hello.alpn) or "-"}, {",".join(hex(v) for v in hello.versions)}')
+    print(f'{"":<28} fuzzed: {outcomes}')
@@ -0,0 +1,210 @@
+#!/usr/bin/env python3
+
+# Measures how long interceptor/http.py takes to parse the headers of a request & a response, which it does a line at a
+# time with the match primitives of the interceptor, compared to the parser it used to have, which matched one byte at a
+# time. The messages are fed to both in pieces of different sizes, to check they get the same result wherever reads end.
+
+import os, sys, time, types, json, logging
+import argparse, asyncio
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+import interceptor
+from importlib.machinery import SourceFileLoader
+
+REQUEST = (
+  b'GET /assets/js/app.4f2a9c.js?v=20240101&lang=en HTTP/1.1\r\n'
+  b'Host: www.example.com\r\n'
+  b'User-Agent: Mozilla/5.0 (X11; Linux x86_64; rv:128.0) Gecko/20100101 Firefox/128.0\r\n'
+  b'Accept: */*\r\n'
+  b'Accept-Language: en-US,en;q=0.5\r\n'
+  b'Accept-Encoding: gzip, deflate, br, zstd\r\n'
+  b'Referer: https://www.example.com/products/category/some-product-name?ref=home\r\n'
+  b'Connection: keep-alive\r\n'
+  b'Cookie: session=8b1c2f0e9d7a4b3c8e6f5a4d3c2b1a0f; prefs=dark%3Dtrue%26compact%3Dfalse; _ga=GA1.2.123456789.1700000000\r\n'
+  b'Sec-Fetch-Dest: script\r\n'
+  b'Sec-Fetch-Mode: no-cors\r\n'
+  b'Sec-Fetch-Site: same-origin\r\n'
+  b'If-None-Match: "5f2a-61b3c9d8e7f00"\r\n'
+  b'\r\n'
+)
+
+RESPONSE = (
+  b'HTTP/1.1 200 OK\r\n'
+  b'Date: Thu, 01 Aug 2024 12:00:00 GMT\r\n'
+  b'Content-Type: application/javascript; charset=utf-8\r\n'
+  b'Content-Length: 24362\r\n'
+  b'Connection: keep-alive\r\n'
+  b'Cache-Control: public, max-age=31536000, immutable\r\n'
+  b'ETag: "5f2a-61b3c9d8e7f01"\r\n'
+  b'Last-Modified: Wed, 31 Jul 2024 08:15:42 GMT\r\n'
+  b'Content-Encoding: gzip\r\n'
+  b'Vary: Accept-Encoding\r\n'
+  b'Strict-Transport-Security: max-age=63072000; includeSubDomains; preload\r\n'
+  b'X-Content-Type-Options: nosniff\r\n'
+  b'Server: nginx\r\n'
+  b'\r\n'
+)
+
+
+# The parser as it was before it read whole lines, matching one byte at a time with a python call for each of them
+class LegacyWrapper(interceptor.ShadowProcessorWrapper):
+  async def match(self, o, search, max=None, min=None, consume=True):
+    if isinstance(search, bytes):
+      if max is None:
+        max = len(search)
+      sstr = search
+      search = lambda x, i: x == sstr[i]
+    if min is None:
+      min = max
+    i = 0
+    rmi = min or 1
+    buf = b''
+    while i < max:
+      buf += await self.read(o + i, rmi - i, max - i, consume=False)
+      while i < len(buf):
+        if not search(buf[i], i):
+          if i < min:
+            raise interceptor.MismatchException()
+          if consume:
+            self.consume(o + i)
+          return o + i, buf[0:i]
+        i += 1
+      rmi = i + 1
+      if consume:
+        self.consume(o + i)
+    return (o + i) & interceptor.R32, buf[0:i]
+
+  async def match_CRLF(self, o):
+    o, _  = await self.match(o, lambda x, i: x == 13 or x == 10, max=1)
+    if _ == b'\r':
+      o, _ = await self.match(o, b'\n')
+    return o
+
+async def legacy_parse_first_request_line(self, o, C):
+  o, method   = await C.match(o, lambda x, i: 65<=x<=90, min=3, max=10) # A-Z
+  o, _        = await C.match(o, b' ')
+  o, location = await C.match(o, lambda x, i: 33<=x<=126, min=1, max=2048) # Any printable ascii character, excluding space
+  o, _        = await C.match(o, b' HTTP/1.')
+  o, version  = await C.match(o, lambda x, i: x == 48 or x == 49, max=1) # 0 or 1
+  o           = await C.match_CRLF(o)
+  return o, method, location, b'HTTP/1.' + version
+
+async def legacy_parse_response_line(self, o, S):
+  o, _        = await S.match(o, b'HTTP/1.')
+  o, version  = await S.match(o, lambda x, i: x == 48 or x == 49, max=1) # 0 or 1
+  o, _        = await S.match(o, b' ')
+  o, code     = await S.match(o, lambda x, i: 48<=x<=57, min=1, max=3) # 0-9
+  o, _        = await S.match(o, b' ')
+  o, location = await S.match(o, lambda x, i: 32<=x<=126, min=0, max=2048) # Any printable ascii character
+  o           = await S.match_CRLF(o)
+  return o, b'HTTP/1.' + version, int(code), location
+
+async def legacy_parse_header(self, o, X):
+  header_value = None
+  while True:
+    c = await X.read(o, 1, 1, consume=False); o += 1
+    if c == b' ':
+      X.consume(o)
+      assert header_value is not None
+      o, header_value_continuation = await X.match(o, lambda x, i: 32<=x<=126, min=1, max=1024 * 8 - len(header_value))
+      header_value += header_value_continuation
+      header_value_continuation = None
+      o = await X.match_CRLF(o)
+      continue
+    if header_value is not None:
+      header_value = header_value.strip()
+      if header_value[0] == b'"'[0] and header_value[-1] == b'"'[0]:
+        header_value = json.loads(header_value)
+      return o-1, (header_name, header_value)
+    X.consume(o)
+    if c == b'\r':
+      o, _ = await X.match(o, b'\n')
+      return o, None
+    if c == b'\n':
+      return o, None
+    assert 33<=c[0]<=126
+    o, header_name = await X.match(o, lambda x, i: 33<=x<=126 and x != 58, min=1, max=255)
+    header_name = bytes(c) + header_name
+    o, _ = await X.match(o, b':')
+    o, header_value = await X.match(o, lambda x, i: 32<=x<=126, min=1, max=1024 * 8)
+    o = await X.match_CRLF(o)
+
+legacy = types.SimpleNamespace(
+  wrapper=LegacyWrapper,
+  parse_first_request_line=legacy_parse_first_request_line,
+  parse_response_line=legacy_parse_response_line,
+  parse_header=legacy_parse_header)
+
+
+class Socket:
+  def __init__(self, data, size):
+    self.data = data
+    self.size = size
+
+  def recv(self, n):
+    res = self.data[:min(n, self.size)]
+    self.data = self.data[len(res):]
+    return res
+
+
+def load_http():
+  m = SourceFileLoader('interceptor.http', os.path.join(interceptor.root, 'interceptor', 'http.py')).load_module()
+  m.I = interceptor
+  m.init()
+  m.wrapper = interceptor.ShadowProcessorWrapper
+  return m
+
+
+logger = logging.getLogger('http_headers')
+
+
+async def parse(http, data, size):
+  I = types.SimpleNamespace(PIs=set(), logger=logger, wake=lambda: None, C=None)
+  SP = interceptor.ShadowProcessor(I, Socket(data, size), len(data), size)
+  I.C = SP
+  PI = types.SimpleNamespace(I=I, logger=logger, cancel=lambda: None)
+  X = http.wrapper(SP, PI)
+  async def headers():
+    if data.startswith(b'HTTP/'):
+      o, *line = await http.parse_response_line(None, X.replied, X)
+    else:
+      o, *line = await http.parse_first_request_line(None, X.replied, X)
+    res = [line]
+    while True:
+      o, header = await http.parse_header(None, o, X)
+      if header is None:
+        return res
+      res.append(header)
+  task = asyncio.ensure_future(headers())
+  # Feed the data as the parser asks for it, like process_stuff would
+  while True:
+    await asyncio.sleep(0)
+    if task.done():
+      return task.result()
+    assert SP.parsejobs, 'Parser is stuck'
+    SP.recv()
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='interceptor/http.py header parsing benchmark', formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+  parser.add_argument('-n', '--iterations', type=int, default=1000, help='number of times to parse each message per repetition')
+  parser.add_argument('--repeat', type=int, default=5, help='number of repetitions, the fastest one is reported')
+  parser.add_argument('-r', '--recv-size', type=int, default=64 * 1024, help='size of the pieces the messages arrive in for the benchmark')
+  args = parser.parse_args()
+  http = load_http()
+  loop = asyncio.new_event_loop()
+  asyncio.set_event_loop(loop)
+  print(f'{"message":<10} {"bytes":>6} {"headers":>8} {"legacy us":>10} {"us":>8} {"speedup":>8}')
+  for name, data in (('request', REQUEST), ('response', RESPONSE)):
+    expected = loop.run_until_complete(parse(http, data, len(data)))
+    for size in (1, 2, 3, 7, 64, 512):
+      for parser in (http, legacy):
+        assert loop.run_until_complete(parse(parser, data, size)) == expected, (name, parser is legacy, size)
+    times = [float('inf')] * 2
+    for r in range(args.repeat):
+      for j, parser in enumerate((legacy, http)):
+        start = time.perf_counter()
+        for i in range(args.iterations):
+          loop.run_until_complete(parse(parser, data, args.recv_size))
+        times[j] = min(times[j], (time.perf_counter() - start) / args.iterations * 1e6)
+    print(f'{name:<10} {len(data):>6} {len(expected) - 1:>8} {times[0]:>10.1f} {times[1]:>8.1f} {times[0] / times[1]:>7.1f}x')
@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+
+# Compares the throughput and peak RSS of the different ways of relaying data between two sockets.
+# Every case runs in its own process, so the RSS of one doesn't influence the others.
+
+import os, sys, time, errno
+import argparse, resource, threading, multiprocessing
+import select, socket
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+import socksproxy
+
+
+# This is how pipe_sockets used to work, a new bytes object for every recv, and a copy for every partial send
+def legacy_pipe_sockets(sa, sb, size):
+  sa.setblocking(False)
+  sb.setblocking(False)
+  a2b = True
+  b2a = True
+  a2b_buf = b''
+  b2a_buf = b''
+  while a2b or b2a:
+    rsl = set()
+    if a2b and len(a2b_buf) == 0: rsl.add(sa)
+    if b2a and len(b2a_buf) == 0: rsl.add(sb)
+    wsl = set()
+    if len(a2b_buf) != 0: wsl.add(sb)
+    if len(b2a_buf) != 0: wsl.add(sa)
+    rs, ws, es = select.select(rsl, wsl, [])
+    if sa in rs:
+      a2b_buf = sa.recv(size)
+      if len(a2b_buf) == 0:
+        a2b = False
+        sb.shutdown(socket.SHUT_WR)
+    if sb in rs:
+      b2a_buf = sb.recv(size)
+      if len(b2a_buf) == 0:
+        b2a = False
+        sa.shutdown(socket.SHUT_WR)
+    if len(a2b_buf) != 0 and sb in ws:
+      try:
+        a2b_buf = a2b_buf[sb.send(a2b_buf):]
+      except BlockingIOError: pass
+    if len(b2a_buf) != 0 and sa in ws:
+      try:
+        b2a_buf = b2a_buf[sa.send(b2a_buf):]
+      except BlockingIOError: pass
+  sa.close()
+  sb.close()
+
+
+def tcp_pair(listener):
+  a = socket.create_connection(listener.getsockname())
+  b, _ = listener.accept()
+  return a, b
+
+
+def run_case(mode, total, size, sink_chunk, result):
+  listener = socket.socket()
+  listener.bind(('127.0.0.1', 0))
+  listener.listen(4)
+  source, sa = tcp_pair(listener)
+  sb, sink = tcp_pair(listener)
+  socksproxy.relay_buffer_size = size
+  socksproxy.use_splice = mode == 'splice'
+
+  def produce():
+    chunk = b'x' * (1024 * 1024)
+    sent = 0
+    while sent < total:
+      sent += source.send(chunk[:total - sent])
+    source.shutdown(socket.SHUT_WR)
+
+  def relay():
+    if mode == 'legacy':
+      legacy_pipe_sockets(sa, sb, size)
+    else:
+      socksproxy.pipe_sockets(sa, sb)
+
+  start = time.monotonic()
+  threads = [threading.Thread(target=produce), threading.Thread(target=relay)]
+  for t in threads:
+    t.start()
+  received = 0
+  while True:
+    res = sink.recv(sink_chunk)
+    if not res:
+      break
+    received += len(res)
+  duration = time.monotonic() - start
+  sink.shutdown(socket.SHUT_WR)
+  for t in threads:
+    t.join()
+  assert received == total, f'{received} != {total}'
+  result.put((total / duration / 1024 / 1024, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024))
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='pipe_sockets throughput & RSS benchmark', formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+  parser.add_argument('-m', '--modes', default='legacy,buffer,splice', help='comma separated list of legacy, buffer and splice')
+  parser.add_argument('-n', '--megabytes', type=int, default=1024, help='amount of data to transfer per case')
+  parser.add_argument('-b', '--buffer-size', type=int, default=16 * 4096, help='relay buffer size')
+  parser.add_argument('-r', '--sink-chunk', type=int, default=16 * 4096, help='recv size of the receiver, small values simulate a slow receiver')
+  args = parser.parse_args()
+  ctx = multiprocessing.get_context('fork')
+  print(f'{"mode":<8} {"MB/s":>10} {"peak RSS MB":>12}')
+  for mode in args.modes.split(','):
+    result = ctx.Queue()
+    p = ctx.Process(target=run_case, args=(mode, args.megabytes * 1024 * 1024, args.buffer_size, args.sink_chunk, result))
+    p.start()
+    mbps, rss = result.get()
+    p.join()
+    print(f'{mode:<8} {mbps:>10.1f} {rss:>12.1f}')
@@ -0,0 +1,367 @@
+#!/usr/bin/env python3
+
+# Load test for the proxies. Starts local stand-in servers and the proxies, drives them with socks clients, and reports
+# connections/s, throughput, time to first byte and the peak RSS of the proxy processes.
+# The servers and the clients run in their own processes, so they don't compete with each other for the GIL.
+
+import os, sys, time, gzip, shlex, struct, random
+import argparse, tempfile, threading, subprocess, multiprocessing
+import socket, ssl, socks
+from socketserver import ThreadingTCPServer, StreamRequestHandler
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from OpenSSL import crypto
+
+try:
+  import brotli
+except ImportError:
+  brotli = None
+
+root = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..')
+
+# name: (proxies to start, entry proxy, whether the client uses TLS, whether the server uses TLS)
+# Every proxy is (script, args), the args can refer to the ports of the proxies by their name & to the ca files.
+SCENARIOS = {
+  'socksproxy': ([('socksproxy.py', '-c direct')], 'socksproxy', False, False),
+  'interceptor': ([('interceptor.py', '-c direct')], 'interceptor', False, False),
+  'retls': ([('retls.py', '-c direct')], 'retls', False, True),
+  'untls': ([('untls.py', '-c direct -t 127.0.0.1:{socksproxy} --ca {ca} --ca-key {ca_key}'), ('socksproxy.py', '-c direct')], 'untls', True, False),
+  'chain': ([('untls.py', '-c 127.0.0.1:{socksproxy} -t 127.0.0.1:{retls} --ca {ca} --ca-key {ca_key}'), ('retls.py', '-c direct'), ('socksproxy.py', '-c direct')], 'untls', True, True),
+  'chain.py': ([('chain.py', '--no-intercept --ca {ca} --ca-key {ca_key}')], 'chain', True, True),
+}
+
+CHUNK = bytes(range(256)) * 256
+
+
+def make_cert(name, issuer_cert=None, issuer_key=None):
+  key = crypto.PKey()
+  key.generate_key(crypto.TYPE_RSA, 2048)
+  cert = crypto.X509()
+  cert.set_version(2)
+  cert.set_serial_number(random.randint(50000000,100000000))
+  cert.get_subject().commonName = name
+  cert.set_pubkey(key)
+  if issuer_cert is None:
+    cert.add_extensions([
+      crypto.X509Extension(b"basicConstraints", True, b"CA:TRUE"),
+      crypto.X509Extension(b"keyUsage", True, b"keyCertSign, cRLSign"),
+      crypto.X509Extension(b"subjectKeyIdentifier", False, b"hash", subject=cert),
+    ])
+    issuer_cert, issuer_key = cert, key
+  else:
+    cert.add_extensions([
+      crypto.X509Extension(b"basicConstraints", False, b"CA:FALSE"),
+      crypto.X509Extension(b"subjectAltName", False, ("DNS:"+name).encode('utf-8')),
+      crypto.X509Extension(b"authorityKeyIdentifier", False, b"keyid:always", issuer=issuer_cert),
+      crypto.X509Extension(b"extendedKeyUsage", False, b"serverAuth"),
+    ])
+  cert.set_issuer(issuer_cert.get_subject())
+  cert.gmtime_adj_notBefore(-24*60*60)
+  cert.gmtime_adj_notAfter(7*24*60*60)
+  cert.sign(issuer_key, 'sha256')
+  return cert, key
+
+
+def write_pem(path, cert, key):
+  with open(path + '.pem', 'wb') as f:
+    f.write(crypto.dump_certificate(crypto.FILETYPE_PEM, cert))
+  with open(path + '.key', 'wb') as f:
+    f.write(crypto.dump_privatekey(crypto.FILETYPE_PEM, key))
+  return path + '.pem', path + '.key'
+
+
+# The client sends how many bytes it's going to upload and wants to download, and then the upload. The server
+# reads all of it, and then sends the download.
+class SinkSource(StreamRequestHandler):
+  def handle(self):
+    header = self.rfile.read(16)
+    if len(header) != 16:
+      return
+    up, down = struct.unpack('!QQ', header)
+    while up > 0:
+      res = self.rfile.read1(min(up, 65536))
+      if not res:
+        return
+      up -= len(res)
+    view = memoryview(CHUNK)
+    while down > 0:
+      n = min(down, len(CHUNK))
+      self.connection.sendall(view[:n])
+      down -= n
+
+
+bodies = {}
+
+def http_body(encoding, size):
+  key = (encoding, size)
+  if key not in bodies:
+    # Something compressible, but not too much
+    body = bytes(random.Random(size).choices(b'abcdefghijklmnopqrstuvwxyz \n', k=size))
+    if encoding == 'gzip':
+      body = gzip.compress(body)
+    elif encoding == 'br':
+      body = brotli.compress(body)
+    bodies[key] = body
+  return bodies[key]
+
+
+# GET /<identity|chunked|gzip|br>/<size>
+class HTTPHandler(BaseHTTPRequestHandler):
+  protocol_version = 'HTTP/1.1'
+
+  def do_GET(self):
+    try:
+      encoding, size = self.path.strip('/').split('/')
+      body = http_body(encoding, int(size))
+    except ValueError:
+      self.send_error(404)
+      return
+    self.send_response(200)
+    self.send_header('Content-Type', 'text/plain')
+    if encoding in ('gzip', 'br'):
+      self.send_header('Content-Encoding', encoding)
+    if encoding == 'chunked':
+      self.send_header('Transfer-Encoding', 'chunked')
+      self.end_headers()
+      for i in range(0, len(body), 16384):
+        chunk = body[i:i+16384]
+        self.wfile.write(b'%x\r\n' % len(chunk) + chunk + b'\r\n')
+      self.wfile.write(b'0\r\n\r\n')
+    else:
+      self.send_header('Content-Length', str(len(body)))
+      self.end_headers()
+      self.wfile.write(body)
+
+  def log_message(self, format, *args):
+    pass
+
+
+class TLSMixIn:
+  def get_request(self):
+    sock, address = super().get_request()
+    return self.context.wrap_socket(sock, server_side=True, do_handshake_on_connect=False), address
+
+
+class Server(ThreadingTCPServer):
+  daemon_threads = True
+  allow_reuse_address = True
+  request_queue_size = 1024
+
+class TLSServer(TLSMixIn, Server):
+  pass
+
+class HTTPServer(ThreadingHTTPServer):
+  request_queue_size = 1024
+
+class HTTPSServer(TLSMixIn, HTTPServer):
+  pass
+
+
+def run_servers(cert, key, ports):
+  context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+  context.load_cert_chain(cert, key)
+  servers = {
+    'tcp': Server(('127.0.0.1', 0), SinkSource),
+    'tls': TLSServer(('127.0.0.1', 0), SinkSource),
+    'http': HTTPServer(('127.0.0.1', 0), HTTPHandler),
+    'https': HTTPSServer(('127.0.0.1', 0), HTTPHandler),
+  }
+  for name, server in servers.items():
+    server.context = context
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+  ports.put({name: server.server_address[1] for name, server in servers.items()})
+  threading.Event().wait()
+
+
+def free_port():
+  with socket.socket() as s:
+    s.bind(('127.0.0.1', 0))
+    return s.getsockname()[1]
+
+
+def start_proxy(script, args, port, env, verbose):
+  cmd = [sys.executable, os.path.join(root, script), '-l', f'127.0.0.1:{port}', *args]
+  out = None if verbose else subprocess.DEVNULL
+  p = subprocess.Popen(cmd, env=env, stdout=out, stderr=out)
+  deadline = time.monotonic() + 20
+  while True:
+    if p.poll() is not None:
+      raise Exception(f'{script} exited with status {p.returncode}')
+    try:
+      socket.create_connection(('127.0.0.1', port)).close()
+      return p
+    except OSError:
+      if time.monotonic() > deadline:
+        p.kill()
+        raise Exception(f'{script} did not start listening')
+      time.sleep(0.05)
+
+
+def descendants(pid):
+  result = [pid]
+  try:
+    with open(f'/proc/{pid}/task/{pid}/children') as f:
+      for child in f.read().split():
+        result += descendants(int(child))
+  except OSError:
+    pass
+  return result
+
+
+def peak_rss(pid):
+  total = 0
+  for p in descendants(pid):
+    try:
+      with open(f'/proc/{p}/status') as f:
+        for line in f:
+          if line.startswith('VmHWM:'):
+            total += int(line.split()[1])
+    except OSError:
+      pass
+  return total / 1024
+
+
+class Client:
+  def __init__(self, args, port, target_port, tls, ca):
+    self.args = args
+    self.port = port
+    self.target_port = target_port
+    self.context = ssl.create_default_context(cafile=ca) if tls else None
+    if args.http:
+      self.request = f'GET /{args.http}/{args.down} HTTP/1.1\r\nHost: {args.hostname}\r\nConnection: close\r\n\r\n'.encode()
+    else:
+      self.request = struct.pack('!QQ', args.up, args.down) + (CHUNK * (args.up // len(CHUNK) + 1))[:args.up]
+
+  # Returns the time to first byte & the amount of data transferred
+  def one(self):
+    start = time.monotonic()
+    s = socks.socksocket()
+    try:
+      s.set_proxy(socks.SOCKS5, '127.0.0.1', self.port, rdns=True)
+      s.connect((self.args.target, self.target_port))
+      if self.context:
+        s = self.context.wrap_socket(s, server_hostname=self.args.hostname)
+      s.sendall(self.request)
+      ttfb = None
+      received = 0
+      while True:
+        res = s.recv(65536)
+        if not res:
+          break
+        if ttfb is None:
+          ttfb = time.monotonic() - start
+        received += len(res)
+      return ttfb, len(self.request) + received
+    finally:
+      s.close()
+
+
+def run_clients(client, threads, counter, total, result):
+  ttfbs = []
+  transferred = [0]
+  errors = [0]
+  lock = threading.Lock()
+
+  def worker():
+    while True:
+      with counter.get_lock():
+        if counter.value >= total:
+          return
+        counter.value += 1
+      try:
+        ttfb, n = client.one()
+      except Exception:
+        with lock:
+          errors[0] += 1
+        continue
+      with lock:
+        if ttfb is not None:
+          ttfbs.append(ttfb)
+        transferred[0] += n
+
+  ts = [threading.Thread(target=worker) for i in range(threads)]
+  for t in ts:
+    t.start()
+  for t in ts:
+    t.join()
+  result.put((ttfbs, transferred[0], errors[0]))
+
+
+def percentile(values, q):
+  if not values:
+    return None
+  return values[min(len(values) - 1, int(len(values) * q))]
+
+
+def fmt(value, scale=1):
+  return '-' if value is None else f'{value * scale:.1f}'
+
+
+def run_scenario(ctx, name, args, server_ports, files):
+  proxies, entry, client_tls, server_tls = SCENARIOS[name]
+  ports = {script[:-3]: free_port() for script, _ in proxies}
+  env = {**os.environ, 'SSL_CERT_FILE': files['ca']}
+  procs = []
+  try:
+    # Start the last hop first, so the others can connect to it right away
+    for script, proxy_args in reversed(proxies):
+      proxy_args = shlex.split(proxy_args.format(**ports, **files)) + shlex.split(args.proxy_args)
+      procs.append(start_proxy(script, proxy_args, ports[script[:-3]], env, args.verbose))
+    server = ('https' if server_tls else 'http') if args.http else ('tls' if server_tls else 'tcp')
+    client = Client(args, ports[entry], server_ports[server], client_tls, files['ca'])
+    counter = ctx.Value('Q', 0)
+    result = ctx.Queue()
+    threads = max(1, args.concurrency // args.processes)
+    start = time.monotonic()
+    clients = [ctx.Process(target=run_clients, args=(client, threads, counter, args.connections, result)) for i in range(args.processes)]
+    for c in clients:
+      c.start()
+    results = [result.get() for c in clients]
+    duration = time.monotonic() - start
+    for c in clients:
+      c.join()
+    rss = sum(peak_rss(p.pid) for p in procs)
+  finally:
+    for p in procs:
+      p.terminate()
+    for p in procs:
+      p.wait()
+  ttfbs = sorted(t for r in results for t in r[0])
+  transferred = sum(r[1] for r in results)
+  errors = sum(r[2] for r in results)
+  ok = args.connections - errors
+  print(f'{name:<12} {ok:>7} {errors:>6} {ok / duration:>9.1f} {transferred / duration / 1024 / 1024:>9.1f} {fmt(percentile(ttfbs, 0.5), 1000):>9} {fmt(percentile(ttfbs, 0.99), 1000):>9} {rss:>12.1f}', flush=True)
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='proxy load test & benchmark', formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+  parser.add_argument('-s', '--scenarios', default=','.join(SCENARIOS), help='comma separated list of scenarios to run')
+  parser.add_argument('-n', '--connections', type=int, default=1000, help='number of connections per scenario')
+  parser.add_argument('-c', '--concurrency', type=int, default=16, help='number of concurrent connections')
+  parser.add_argument('-p', '--processes', type=int, default=1, help='number of client processes the concurrent connections are distributed over')
+  parser.add_argument('-u', '--up', type=int, default=0, help='bytes the client sends per connection, in addition to the request. Not used for http')
+  parser.add_argument('-d', '--down', type=int, default=64 * 1024, help='bytes the server sends per connection. For http, the size of the body before any compression')
+  parser.add_argument('--http', choices=['identity', 'chunked', 'gzip', 'br'], help='use http requests, and return the body using this encoding')
+  parser.add_argument('--target', default='localhost>127.0.0.1', help='socks target host, the servers listen on 127.0.0.1')
+  parser.add_argument('--hostname', default='localhost', help='host name for TLS & http requests')
+  parser.add_argument('-a', '--proxy-args', default='', help='additional arguments for all proxies, for example --proxy-args="--event-loop --max-handlers 64"')
+  parser.add_argument('-v', '--verbose', action='store_true', help='show the output of the proxies')
+  args = parser.parse_args()
+  if args.http == 'br' and not brotli:
+    parser.error('brotli is not installed')
+
+  ctx = multiprocessing.get_context('fork')
+  with tempfile.TemporaryDirectory() as tmp:
+    ca_cert, ca_key = make_cert('Benchmark CA')
+    files = {}
+    files['ca'], files['ca_key'] = write_pem(os.path.join(tmp, 'CA'), ca_cert, ca_key)
+    cert, key = write_pem(os.path.join(tmp, 'localhost'), *make_cert(args.hostname, ca_cert, ca_key))
+    server_ports = ctx.Queue()
+    servers = ctx.Process(target=run_servers, args=(cert, key, server_ports), daemon=True)
+    servers.start()
+    server_ports = server_ports.get()
+    print(f'{"scenario":<12} {"conns":>7} {"errors":>6} {"conn/s":>9} {"MB/s":>9} {"ttfb p50":>9} {"ttfb p99":>9} {"peak RSS MB":>12}')
+    try:
+      for name in args.scenarios.split(','):
+        run_scenario(ctx, name, args, server_ports, files)
+    finally:
+      servers.terminate()
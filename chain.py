@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+
+import os
+import signal
+import logging
+import argparse
+import untls, retls, interceptor
+from untls import TLSStripper, add_cert_arguments, create_certgen
+from retls import ReTLS
+from interceptor import Interceptor, add_interceptor_arguments
+from socksproxy import pipe_sockets, str2ipport, setprocname, add_server_arguments, serve, enable_ktls
+
+
+# untls.py, interceptor.py, retls.py and socksproxy.py in one process. Instead of connecting to the next proxy
+# using socks, the next stage just works directly on the sockets it would otherwise have gotten from it.
+class Chain(TLSStripper, Interceptor, ReTLS):
+  def plain_connect(self):
+    via = args.via or args.upstream
+    self.logger.info(f'Connecting to remote {self.remote_address} :{self.remote_port}')
+    s = self.mksocket(via)
+    return self.rconnect(s, via)
+
+  def relay_plain(self, data):
+    if args.via or not args.intercept:
+      return super().relay_plain(data)
+    if not self.lazy_plain_connect():
+      return
+    if self.intercept(self.sdirect, self.connection, data):
+      self.sdirect = None
+
+  def relay_decrypted(self, ssock, sni):
+    if args.tls_via:
+      return super().relay_decrypted(ssock, sni)
+    self.logger.info(f'Connecting to remote {sni} :{self.remote_port} via {self.remote_address}')
+    with self.tls_connect(args.upstream, sni) as s:
+      if args.intercept:
+        self.intercept(s, ssock, relay=pipe_sockets, host=sni)
+      else:
+        pipe_sockets(s, ssock, logger=self.logger)
+
+
+def sighup(a,b):
+  interceptor.reload_all()
+
+
+if __name__ == '__main__':
+  logging.root.setLevel(logging.NOTSET if os.environ.get('DEBUG') is not None else logging.INFO)
+  setprocname(__file__)
+  parser = argparse.ArgumentParser(description='untls, interceptor, retls & socksproxy in a single process', formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+  parser.add_argument('-l', '--listen', type=str2ipport('0.0.0.0',1666, False), help='IP:PORT to listen on', default='0.0.0.0:1666')
+  parser.add_argument('-c', '--via', type=str2ipport(), help='IP:PORT of socks proxy to connect to for undecryptable traffic, or "direct" to handle it in this process', default='direct')
+  parser.add_argument('-t', '--tls-via', type=str2ipport(), help='IP:PORT of socks proxy to connect to for decrypted traffic, or "direct" to handle it in this process', default='direct')
+  parser.add_argument('-u', '--upstream', type=str2ipport(), help='IP:PORT of socks proxy to connect to for traffic handled in this process, or "direct" for none', default='direct')
+  parser.add_argument('--early-connect', action='store_true', help='connect to the remote before accepting the socks connection, to refuse connections to unreachable targets')
+  parser.add_argument('--ktls', action='store_true', help='let the kernel encrypt the traffic to clients and servers where possible, falls back to OpenSSL if it can\'t')
+  parser.add_argument('--no-intercept', dest='intercept', action='store_false', help="don't run the interceptors on traffic handled in this process")
+  add_interceptor_arguments(parser)
+  add_cert_arguments(parser)
+  add_server_arguments(parser)
+  args = parser.parse_args()
+  if args.intercept:
+    interceptor.reload_all()
+    signal.signal(signal.SIGHUP, sighup)
+  untls.args = interceptor.args = retls.args = args
+  untls.CA = create_certgen(args)
+  retls.context = retls.create_context(args.ktls)
+  if args.ktls:
+    enable_ktls(untls.CA.context)
+  serve(args, Chain)
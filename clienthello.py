@@ -0,0 +1,132 @@
+import struct
+
+# ClientHellos are a few hundred bytes, or a few KB with post-quantum key shares. Anything much larger is probably not one.
+MAX_LENGTH = 64 * 1024
+RECV_SIZE = 16 * 1024
+
+# Extension types
+SERVER_NAME = 0
+ALPN = 16
+SUPPORTED_VERSIONS = 43
+
+
+class ClientHello:
+  def __init__(self):
+    self.version = None # ClientHello::legacy_version
+    self.sni = None
+    self.alpn = []
+    self.versions = [] # From the supported_versions extension if there is one, otherwise just the legacy version
+    self.length = 0 # Number of bytes of the records the ClientHello was in
+
+
+class Reader:
+  def __init__(self, data):
+    self.data = data
+    self.off = 0
+
+  def remaining(self):
+    return len(self.data) - self.off
+
+  def take(self, n):
+    if self.off + n > len(self.data):
+      raise ValueError('Truncated ClientHello')
+    res = self.data[self.off:self.off+n]
+    self.off += n
+    return res
+
+  def rest(self):
+    return self.take(self.remaining())
+
+  def u8(self):
+    return self.take(1)[0]
+
+  def u16(self):
+    return struct.unpack('!H', self.take(2))[0]
+
+  # Variable length vector with a length field of n bytes
+  def vector(self, n):
+    return Reader(self.take(int.from_bytes(self.take(n), 'big')))
+
+  def done(self):
+    if self.off != len(self.data):
+      raise ValueError('Trailing data in ClientHello')
+
+
+# Parses the handshake records at the start of data. Returns None if more data is needed, and raises ValueError as
+# soon as it's clear that this isn't a TLS ClientHello. The ClientHello may span several records.
+def parse(data):
+  body = bytearray()
+  off = 0
+  while True:
+    if len(data) - off < 5:
+      if data[off:off+1] not in (b'', b'\x16'):
+        raise ValueError('Not a handshake record')
+      return None
+    ctype, version, length = struct.unpack_from('!BHH', data, off)
+    if ctype != 22: # ContentType::handshake
+      raise ValueError('Not a handshake record')
+    if version >> 8 != 3:
+      raise ValueError(f'Unexpected record version {version:#06x}')
+    if length == 0 or length > 2**14:
+      raise ValueError(f'Invalid record length {length}')
+    if not body and len(data) > off + 5 and data[off+5] != 1: # HandshakeType::client_hello
+      raise ValueError('Not a ClientHello')
+    if len(data) - off - 5 < length:
+      return None
+    body += data[off+5:off+5+length]
+    off += 5 + length
+    if len(body) >= 4:
+      hlength = int.from_bytes(body[1:4], 'big')
+      if hlength > MAX_LENGTH:
+        raise ValueError(f'ClientHello too long ({hlength} bytes)')
+      if len(body) >= 4 + hlength:
+        break
+  hello = parse_body(Reader(bytes(body[4:4+hlength])))
+  hello.length = off
+  return hello
+
+
+def parse_body(r):
+  hello = ClientHello()
+  hello.version = r.u16()
+  if hello.version >> 8 != 3:
+    raise ValueError(f'Unexpected ClientHello version {hello.version:#06x}')
+  r.take(32) # random
+  if r.vector(1).remaining() > 32: # legacy_session_id
+    raise ValueError('Session id too long')
+  suites = r.vector(2)
+  if suites.remaining() == 0 or suites.remaining() % 2:
+    raise ValueError('Invalid cipher suites')
+  if r.vector(1).remaining() == 0: # legacy_compression_methods
+    raise ValueError('No compression methods')
+  hello.versions = [hello.version]
+  if r.remaining() == 0: # No extensions at all
+    return hello
+  extensions = r.vector(2)
+  r.done()
+  seen = set()
+  while extensions.remaining():
+    etype = extensions.u16()
+    edata = extensions.vector(2)
+    if etype in seen:
+      raise ValueError(f'Duplicate extension {etype}')
+    seen.add(etype)
+    if etype == SERVER_NAME:
+      names = edata.vector(2)
+      edata.done()
+      while names.remaining():
+        ntype = names.u8()
+        name = names.vector(2).rest()
+        if ntype == 0 and name and hello.sni is None: # NameType::host_name
+          hello.sni = name.decode('ascii')
+    elif etype == ALPN:
+      protocols = edata.vector(2)
+      edata.done()
+      while protocols.remaining():
+        hello.alpn.append(protocols.vector(1).rest().decode('latin-1'))
+    elif etype == SUPPORTED_VERSIONS:
+      versions = edata.vector(1)
+      edata.done()
+      hello.versions = [versions.u16() for i in range(versions.remaining() // 2)]
+      versions.done()
+  return hello
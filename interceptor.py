@@ -1,25 +1,37 @@
 #!/usr/bin/env python3
 
 import re
+import math
 import time
 import bisect
 import logging
+import threading
+import collections
 import asyncio
 import os, sys, signal, argparse, traceback
-import ssl, select, socket, struct, random
+import ssl, selectors, socket, struct, random
 from functools import total_ordering
-from socksproxy import SocksProxy, ThreadingTCPServer, pipe_sockets, str2ipport, setprocname
+from socksproxy import SocksProxy, ThreadingTCPServer, Splicer, pipe_sockets, relay_sockets, can_splice, str2ipport, setprocname, add_server_arguments, serve
 from socketserver import ThreadingMixIn, TCPServer, StreamRequestHandler
 from importlib.machinery import SourceFileLoader
+import metrics
 
 R32 = 0xFFFFFFFF
-ARBITRARY_BUFFER_LIMIT = 1024 * 10 # 10 KiB
+SEND_SIZE = 16 * 1024 # One TLS record
+SKIP_ROUNDS = 4 # Chunks of skipped data relayed in one go, see recv_skipped
 
 job_data_holdback_timeout = 10
 
+CLIENT_BYTES = metrics.series('mitm_interceptor_bytes_total', side='client')
+SERVER_BYTES = metrics.series('mitm_interceptor_bytes_total', side='server')
+
 config = {}
 mods = {}
 
+# All interceptors of the process run on this loop, see get_intercept_loop
+intercept_loop = None
+intercept_loop_lock = threading.Lock()
+
 root = os.path.dirname(os.path.realpath(__file__))
 
 def reload_mods():
@@ -46,6 +58,40 @@ def reload_all():
 def sighup(a,b):
   reload_all()
 
+# Interceptor modules can declare which connections they could possibly make sense of, so that the others don't have
+# to be started for them at all. Anything a module leaves out doesn't rule out any connection.
+#   ports = {80, 8080}         destination ports
+#   hosts = [r'.*\.example']   regexes the whole host name or SNI has to match
+#   signatures = [b'GET ']     what the data of the client starts with
+def prefilter(mod, port, host):
+  ports = getattr(mod, 'ports', None)
+  if ports is not None and port not in ports:
+    return False
+  hosts = getattr(mod, 'hosts', None)
+  if hosts is not None and not any(re.fullmatch(h, host or '') for h in hosts):
+    return False
+  return True
+
+# Returns None if data is too short to tell yet, unless final says no more is coming before the interceptors start
+def signature_match(mod, data, final=False):
+  signatures = getattr(mod, 'signatures', None)
+  if signatures is None:
+    return True
+  if any(data.startswith(s) for s in signatures):
+    return True
+  if not final and any(s.startswith(data) for s in signatures):
+    return None
+  return False
+
+# Created on first use, so that forked workers each get their own
+def get_intercept_loop():
+  global intercept_loop
+  with intercept_loop_lock:
+    if intercept_loop is None:
+      intercept_loop = asyncio.new_event_loop()
+      threading.Thread(target=intercept_loop.run_forever, name='intercept', daemon=True).start()
+  return intercept_loop
+
 @total_ordering
 class ReadJob:
   def __init__(self, min, SP):
@@ -69,30 +115,120 @@ class ProtocolValidationException(Exception):
 class MismatchException(ProtocolValidationException):
   pass
 
+# A queue of bytes made of the chunks as they were received, so appending and trimming never copy the rest of the data.
+# The chunks are immutable, views of them stay valid after the buffer changed. Views spanning several chunks merge them.
+class StreamBuffer:
+  def __init__(self, data=b''):
+    self.chunks = collections.deque()
+    self.size = 0
+    self.append(data)
+
+  def __len__(self):
+    return self.size
+
+  def __bytes__(self):
+    return b''.join(self.chunks)
+
+  def append(self, data):
+    if len(data):
+      self.chunks.append(memoryview(data).cast('B'))
+      self.size += len(data)
+
+  def extend(self, chunks):
+    for chunk in chunks:
+      self.append(chunk)
+
+  def clear(self):
+    self.chunks.clear()
+    self.size = 0
+
+  # Returns the data from start to end as a memoryview
+  def view(self, start, end):
+    end = min(end, self.size)
+    i = 0
+    for chunk in self.chunks:
+      if start < len(chunk):
+        break
+      start -= len(chunk)
+      end -= len(chunk)
+      i += 1
+    else:
+      return memoryview(b'')
+    if end <= len(self.chunks[i]):
+      return self.chunks[i][start:end]
+    j = i
+    n = 0
+    while n < end:
+      n += len(self.chunks[j])
+      j += 1
+    merged = memoryview(b''.join([self.chunks[k] for k in range(i, j)]))
+    for k in range(i, j):
+      del self.chunks[i]
+    self.chunks.insert(i, merged)
+    return merged[start:end]
+
+  # Removes the first n bytes, and returns them as a list of chunks
+  def pop(self, n):
+    n = min(n, self.size)
+    self.size -= n
+    res = []
+    while n:
+      chunk = self.chunks.popleft()
+      if len(chunk) > n:
+        self.chunks.appendleft(chunk[n:])
+        chunk = chunk[:n]
+      res.append(chunk)
+      n -= len(chunk)
+    return res
+
+  def trim(self, n):
+    self.pop(n)
+
+
 class ShadowProcessor:
-  def __init__(self, I, socket):
+  def __init__(self, I, socket, window, recv_size):
     self.EOF = False
-    self.data = b'';
+    self.data = StreamBuffer()
     self.offset = 0 # Offset of start of data in a 32bit unsigned integer ring
+    self.window = window # Maximum amount of data kept, reading stops until some of it was replied or discarded
+    self.recv_size = recv_size
     self.socket = socket
     self.parsejobs = []
     self.I = I
-    self.to_be_sent = b''
+    self.to_be_sent = StreamBuffer()
     self.recv_waiting = asyncio.get_event_loop().create_future()
     self.D = None
     self.last_data_time = time.monotonic()
+    self.timeout = None # Timer for check_timeouts
+    self.skipping = 0 # Number of bytes to pass on without buffering them, see skip
+    self.skipped = None
+    self.pipe = None # Splicer for skipped data of the other side which is to be sent to this one
 
   def send_ready(self):
-    return len(self.to_be_sent)
+    return len(self.to_be_sent) or (self.pipe is not None and len(self.pipe)) or (hasattr(self.socket, 'send_pending') and self.socket.send_pending())
 
   def flush_some(self):
-    if len(self.to_be_sent) == 0:
+    # A TLSConnection may still have encrypted data from an earlier send
+    if hasattr(self.socket, 'send_pending') and self.socket.send_some():
       return
-    nbytes = self.socket.send(self.to_be_sent)
-    if nbytes > 0:
-      self.to_be_sent = self.to_be_sent[nbytes:]
-      if len(self.to_be_sent) == 0:
-        self.to_be_sent = b''
+    # Anything in the pipe was skipped before whatever is in to_be_sent arrived
+    if self.pipe is not None and len(self.pipe):
+      try:
+        self.pipe.drain(self.socket)
+      except BlockingIOError:
+        return
+      if len(self.pipe):
+        return
+    while len(self.to_be_sent):
+      # Small chunks get merged, instead of sending a TLS record for each of them
+      chunk = self.to_be_sent.view(0, SEND_SIZE)
+      try:
+        nbytes = self.socket.send(chunk)
+      except (ssl.SSLWantReadError, ssl.SSLWantWriteError, BlockingIOError):
+        return
+      self.to_be_sent.trim(nbytes)
+      if nbytes < len(chunk):
+        return
 
   # Stuff needed before any data manipulation
   def pre_flush(self):
@@ -108,7 +244,7 @@ class ShadowProcessor:
   def discard(self, o):
     SPW = self.pre_flush()
     diff = (self.offset - o) & R32
-    self.data = self.data[diff:]
+    self.data.trim(diff)
     self.offset = o
     diff = (o - SPW.consumed) & R32
     if diff < 0x80000000:
@@ -116,10 +252,10 @@ class ShadowProcessor:
 
   def send(self, buf):
     self.D.pre_flush()
-    self.to_be_sent += buf
+    self.to_be_sent.append(bytes(buf))
 
   def recv_ready(self):
-    return not self.EOF and (len(self.data) == 0 or len(self.parsejobs) != 0) and len(self.I.PIs) != 0
+    return not self.EOF and (len(self.data) == 0 or len(self.parsejobs) != 0) and len(self.I.PIs) != 0 and len(self.data) < self.window
 
   def get_all_wrappers(self):
     if len(self.I.PIs) == 0:
@@ -137,31 +273,24 @@ class ShadowProcessor:
     replied_min  = min(((x.replied  - offset) & R32 for x in self.get_all_wrappers()), default=0)
     consumed_min = min(((x.consumed - offset) & R32 for x in self.get_all_wrappers()), default=0)
     replyable = min(replied_min, consumed_min)
-    self.D.to_be_sent += self.data[0:replyable]
-    self.data = self.data[replyable:]
-    if len(self.data) == 0:
-      self.data = b''
+    self.D.to_be_sent.extend(self.data.pop(replyable))
     self.offset = (offset + replyable) & R32
 
   def recv(self):
-    assert len(self.data) < ARBITRARY_BUFFER_LIMIT, len(self.data)
+    if self.skipping:
+      return self.recv_skipped()
     self.last_data_time = time.monotonic()
-    res = self.socket.recv(4096)
+    try:
+      res = self.socket.recv(min(self.recv_size, self.window - len(self.data)))
+    except (ssl.SSLWantReadError, ssl.SSLWantWriteError, BlockingIOError):
+      # For SSL sockets, there may not have been a complete record yet, or it wasn't application data
+      return
+    metrics.counters()[CLIENT_BYTES if self is self.I.C else SERVER_BYTES] += len(res)
     if len(res) == 0:
-      self.EOF = True
-      self.I.logger.info('C->S EOF' if self.socket == self.I.C.socket else 'S->C EOF')
-      jobs = self.parsejobs
-      self.parsejobs = None
-      for job in jobs:
-        job.queued = False
-        job.future.cancel()
-      for W in self.get_all_wrappers():
-        try:
-          W.onEOF()
-        except:
-          traceback.print_exc()
+      self.eof()
     else:
-      self.data += res
+      self.data.append(res)
+      self.schedule_timeouts()
       n = len(self.data)
       while len(self.parsejobs):
         job = self.parsejobs[0]
@@ -173,28 +302,109 @@ class ShadowProcessor:
       if len(self.parsejobs) == 0:
         self.recv_waiting = asyncio.get_event_loop().create_future()
 
+  # Skipped data goes straight to the other side, through a pipe if it can be spliced. Usually it can be sent right away,
+  # so this goes on for up to SKIP_ROUNDS chunks, as long as neither socket blocks, before the other connections get a turn.
+  def recv_skipped(self):
+    for i in range(SKIP_ROUNDS):
+      if not self.skipping or self.D.send_ready():
+        break
+      try:
+        if self.D.pipe is not None:
+          nbytes = self.D.pipe.fill(self.socket, min(self.skipping, self.D.pipe.size))
+        else:
+          res = self.socket.recv(min(self.recv_size, self.skipping))
+          self.D.to_be_sent.append(res)
+          nbytes = len(res)
+      except (ssl.SSLWantReadError, ssl.SSLWantWriteError, BlockingIOError):
+        return
+      metrics.counters()[CLIENT_BYTES if self is self.I.C else SERVER_BYTES] += nbytes
+      if nbytes == 0:
+        return self.eof()
+      self.offset = (self.offset + nbytes) & R32
+      self.skipping -= nbytes
+      self.D.flush_some()
+    if not self.skipping:
+      self.skipped.set_result(None)
+      self.recv_waiting = asyncio.get_event_loop().create_future()
+
+  def eof(self):
+    self.EOF = True
+    self.I.logger.info('C->S EOF' if self.socket == self.I.C.socket else 'S->C EOF')
+    jobs = self.parsejobs
+    self.parsejobs = None
+    for job in jobs:
+      job.queued = False
+      job.future.cancel()
+    if self.skipped is not None:
+      self.skipped.cancel()
+    for W in self.get_all_wrappers():
+      try:
+        W.onEOF()
+      except:
+        traceback.print_exc()
+
+  # Passes the next n bytes, or everything until EOF if n is math.inf, on to the other side without buffering them.
+  # All the data there is must have been replied already. Returns the offset after them.
+  async def skip(self, n):
+    self.move_stuff_to_reply_queue()
+    assert not len(self.data)
+    if self.D.pipe is None and can_splice(self.socket, self.D.socket):
+      self.D.pipe = Splicer()
+    self.skipping = n
+    self.skipped = asyncio.get_event_loop().create_future()
+    if not self.recv_waiting.done():
+      self.recv_waiting.set_result(None)
+    self.I.wake()
+    try:
+      await self.skipped
+    finally:
+      self.skipping = 0
+      self.skipped = None
+    return self.offset
+
+  # Jobs time out if there is data, but not enough for them. The timer only runs while that's the case.
+  def schedule_timeouts(self):
+    if self.timeout or not self.parsejobs or not len(self.data):
+      return
+    deadline = min(max(job.time, self.last_data_time) for job in self.parsejobs) + job_data_holdback_timeout
+    self.timeout = asyncio.get_event_loop().call_later(max(deadline - time.monotonic(), 0), self.check_timeouts)
+
   def check_timeouts(self):
+    self.timeout = None
     if not self.parsejobs:
       return
-    for job in self.parsejobs:
+    for job in list(self.parsejobs):
       if len(self.data):
         diff = time.monotonic() - max(job.time, self.last_data_time)
-        if diff > job_data_holdback_timeout:
+        if diff >= job_data_holdback_timeout:
           self.I.logger.info("A job timed out")
           self.parsejobs.remove(job)
           job.queued = False
           job.future.cancel()
+    self.schedule_timeouts()
+
+  def close(self):
+    if self.timeout:
+      self.timeout.cancel()
+      self.timeout = None
+    if self.pipe is not None:
+      self.pipe.close()
+      self.pipe = None
 
   async def read(self, o, mi, ma):
     assert mi <= ma
     if ((o - self.offset) & R32) + mi > len(self.data):
-      assert ((o - self.offset) & R32) + mi < ARBITRARY_BUFFER_LIMIT, "0x%0.8X + 0x%x" % ( ((o - self.offset) & R32), mi )
+      if ((o - self.offset) & R32) + mi > self.window:
+        # Waiting for it would never end, the data before it isn't going anywhere
+        raise ProtocolValidationException("Read of 0x%x bytes at 0x%0.8X doesn't fit into the window" % (mi, (o - self.offset) & R32))
       assert not self.EOF
       job = ReadJob(o+mi, self)
       bisect.insort(self.parsejobs, job)
       job.queued = True
       if not self.recv_waiting.done():
         self.recv_waiting.set_result(None)
+      self.schedule_timeouts()
+      self.I.wake()
       try:
         await job.future
       finally:
@@ -205,7 +415,7 @@ class ShadowProcessor:
     end = min(len(self.data), o+ma)
     assert o < end, '0x%0.8X < 0x%X' % (o, end)
     assert end >= mi, f'{mi} >= {end}'
-    return self.data[o:end]
+    return self.data.view(o, end)
 
   def validate_silence(self):
     if not self.data:
@@ -218,6 +428,15 @@ class ShadowProcessor:
         W.PI.cancel()
 
 
+# Compiles a set of bytes, given as bytes or a predicate, for match_charset. The pattern finds the first byte not in it.
+def charset(chars):
+  if callable(chars):
+    chars = bytes(x for x in range(256) if chars(x))
+  if not chars:
+    raise ValueError('A charset needs at least one byte')
+  return re.compile(b'[^' + b''.join(b'\\x%02x' % x for x in chars) + b']')
+
+
 def ellide(s, n=20):
   if n < 3: n = 3
   if len(s) <= n:
@@ -249,12 +468,15 @@ class ShadowProcessorWrapper:
   def reply(self, o):
     if o <= self.replied:
       return
-    assert ((o - self.replied) & R32) < ARBITRARY_BUFFER_LIMIT, "0x%0.8X" % ((o - self.replied) & R32)
+    assert ((o - self.replied) & R32) <= self.SP.window, "0x%0.8X" % ((o - self.replied) & R32)
     self.replied = o & R32
 
   def consume(self, o):
-    assert ((o - self.consumed) & R32) < ARBITRARY_BUFFER_LIMIT, "0x%0.8X" % ((o - self.consumed) & R32)
-    self.PI.logger.debug(('consume', self.consumed, ((o - self.consumed) & R32), ellide(self.SP.data[(self.consumed-self.SP.offset)&R32:(o-self.SP.offset)&R32]), ellide(self.SP.data[(o-self.SP.offset)&R32:])))
+    assert ((o - self.consumed) & R32) <= self.SP.window, "0x%0.8X" % ((o - self.consumed) & R32)
+    if self.PI.logger.isEnabledFor(logging.DEBUG):
+      start = (self.consumed - self.SP.offset) & R32
+      end = (o - self.SP.offset) & R32
+      self.PI.logger.debug(('consume', self.consumed, ((o - self.consumed) & R32), ellide(bytes(self.SP.data.view(start, end))), ellide(bytes(self.SP.data.view(end, len(self.SP.data))))))
     self.consumed = o & R32
     if self.transparent:
       self.reply(o)
@@ -274,7 +496,34 @@ class ShadowProcessorWrapper:
       self.consume(end)
     return ret
 
+  # Lets the n bytes at o, or everything from o on if n is None, pass on unchanged without looking at them, and returns
+  # the offset after them. If this is the only interceptor left, the ones which haven't arrived yet are relayed right
+  # away, without going through read. Everything before o must have been consumed.
+  async def skip(self, o, n=None):
+    if n is None:
+      n = math.inf
+    while n:
+      buffered = min(n, len(self.SP.data) - ((o - self.SP.offset) & R32))
+      o = (o + buffered) & R32
+      n -= buffered
+      self.consume(o)
+      self.reply(o)
+      if not n:
+        break
+      if len(self.SP.get_all_wrappers()) == 1:
+        o = await self.SP.skip(n)
+        self.consumed = self.replied = o
+        break
+      await self.read(o, 1, 1, consume=False)
+    return o
+
+  # Matches between min and max bytes, passing each of them to search. Literal bytes and charsets are handed over to
+  # match_literal and match_charset, which don't need to look at every byte in python.
   async def match(self, o, search, max=None, min=None, consume=True):
+    if isinstance(search, re.Pattern):
+      return await self.match_charset(o, search, max=max, min=min, consume=consume)
+    if isinstance(search, bytes) and max is None and min is None:
+      return await self.match_literal(o, search, consume=consume)
     if isinstance(search, bytes):
       if max is None:
         max = len(search)
@@ -283,27 +532,74 @@ class ShadowProcessorWrapper:
     if min is None:
       min = max
     i = 0
-    rmi = min
-    buf = b''
+    rmi = min or 1
+    parts = []
     while i < max:
-      buf += await self.read(o + i, rmi - i, max, consume=False)
-      while i < len(buf):
-        if not search(buf[i], i):
+      buf = await self.read(o + i, rmi - i, max - i, consume=False)
+      for j in range(len(buf)):
+        if not search(buf[j], i):
           if i < min:
             raise MismatchException()
           if consume:
             self.consume(o + i)
-          return o + i, buf[0:i]
+          parts.append(buf[:j])
+          return o + i, b''.join(parts)
         i += 1
+      parts.append(buf)
+      rmi = i + 1
+      if consume:
+        self.consume(o + i)
+    return (o + i) & R32, b''.join(parts)
+
+  async def match_literal(self, o, literal, consume=True):
+    buf = await self.read(o, len(literal), len(literal), consume=False)
+    if buf != literal:
+      raise MismatchException()
+    o = (o + len(literal)) & R32
+    if consume:
+      self.consume(o)
+    return o, literal
+
+  # Matches a run of between min and max bytes of a charset
+  async def match_charset(self, o, chars, max, min=None, consume=True):
+    if min is None:
+      min = max
+    i = 0
+    rmi = min or 1
+    parts = []
+    while i < max:
+      buf = await self.read(o + i, rmi - i, max - i, consume=False)
+      m = chars.search(buf)
+      if m:
+        i += m.start()
+        if i < min:
+          raise MismatchException()
+        if consume:
+          self.consume(o + i)
+        parts.append(buf[:m.start()])
+        return (o + i) & R32, b''.join(parts)
+      i += len(buf)
+      parts.append(buf)
       rmi = i + 1
       if consume:
         self.consume(o + i)
-    return (o + i) & R32, buf[0:i]
+    return (o + i) & R32, b''.join(parts)
 
+  # Matches CRLF or a lone LF, reading both bytes at once when they are there
   async def match_CRLF(self, o):
-    o, _  = await self.match(o, lambda x, i: x == 13 or x == 10, max=1)
-    if _ == b'\r':
-      o, _ = await self.match(o, b'\n')
+    buf = await self.read(o, 1, 2, consume=False)
+    if buf[0] == 13:
+      if len(buf) < 2:
+        buf = await self.read(o, 2, 2, consume=False)
+      if buf[1] != 10:
+        raise MismatchException()
+      n = 2
+    elif buf[0] == 10:
+      n = 1
+    else:
+      raise MismatchException()
+    o = (o + n) & R32
+    self.consume(o)
     return o
 
 
@@ -322,6 +618,7 @@ class ProtocolInterceptor:
     if self.matched:
       return
     self.logger.info("MATCH")
+    self.outcome('match')
     self.matched = True
     for PI in self.I.PIs:
       if PI != self:
@@ -342,19 +639,46 @@ class ProtocolInterceptor:
       try:
         try:
           await self.mod.intercept(self, self.C, self.S)
+          self.outcome('done')
         finally:
           remove()
+          self.I.wake()
           self.logger.info("DONE")
       except asyncio.CancelledError:
-        pass
+        self.outcome('cancelled')
       except (ProtocolValidationException, AssertionError):
+        self.outcome('invalid' if self.matched else 'mismatch')
         if self.matched:
           traceback.print_exc()
       except:
+        self.outcome('error')
         traceback.print_exc()
     self.future = asyncio.ensure_future(waiter())
     self.I.PIs.add(self)
 
+  # Writes all of data to a pipe or similar file without blocking the event loop, which all connections share
+  async def write(self, f, data):
+    loop = asyncio.get_event_loop()
+    fd = f.fileno()
+    os.set_blocking(fd, False)
+    data = memoryview(data)
+    while len(data):
+      try:
+        data = data[os.write(fd, data):]
+        continue
+      except BlockingIOError:
+        pass
+      self.I.wake()
+      writable = loop.create_future()
+      loop.add_writer(fd, lambda: writable.done() or writable.set_result(None))
+      try:
+        await writable
+      finally:
+        loop.remove_writer(fd)
+
+  def outcome(self, outcome):
+    metrics.inc(metrics.series('mitm_interceptor_outcomes_total', interceptor=self.name, outcome=outcome))
+
   def cancel(self):
     self.logger.debug("cancel")
     if self.future and not self.future.done():
@@ -364,18 +688,51 @@ class Interceptor(SocksProxy):
   def remote_connect(self):
     self.logger.info(f'Connecting to remote {self.remote_domain} :{self.remote_port} via {self.remote_address}')
     s = self.mksocket(args.via)
-    self.rconnect(s, args.via)
-    self.sdirect = s
+    self.sdirect = self.rconnect(s, args.via)
+
+  # Interceptors only give up control while waiting for data, in write or when they're done, so this is when
+  # anything they did could change which sockets need to be waited for
+  def wake(self):
+    if self.wakeup and not self.wakeup.done():
+      self.wakeup.set_result(None)
+
+  # Waits for any of the sockets in rsl to become readable or any in wsl writable, or for a call to wake
+  async def wait_io(self, rsl, wsl, poll=False):
+    loop = asyncio.get_event_loop()
+    self.wakeup = loop.create_future()
+    rs = set()
+    ws = set()
+    def ready(s, ready_set):
+      ready_set.add(s)
+      self.wake()
+    for s in rsl:
+      loop.add_reader(s, ready, s, rs)
+    for s in wsl:
+      loop.add_writer(s, ready, s, ws)
+    if poll:
+      # Don't wait, but still pick up anything which is ready already
+      loop.call_soon(self.wake)
+    try:
+      await self.wakeup
+    finally:
+      self.wakeup = None
+      for s in rsl:
+        loop.remove_reader(s)
+      for s in wsl:
+        loop.remove_writer(s)
+    return rs, ws
 
   async def process_stuff(self, S,C):
     while True:
       rsl = set()
       wsl = set()
       if not S.send_ready() and not C.send_ready():
-        wait_list = [self.PIs_done]
+        self.wakeup = asyncio.get_event_loop().create_future()
+        wait_list = [self.PIs_done, self.wakeup]
         if not S.EOF: wait_list.append(S.recv_waiting)
         if not C.EOF: wait_list.append(C.recv_waiting)
         await asyncio.wait(wait_list, return_when=asyncio.FIRST_COMPLETED);
+        self.wakeup = None
         S.move_stuff_to_reply_queue()
         C.move_stuff_to_reply_queue()
         if self.PIs_done.done() and not S.send_ready() and not C.send_ready():
@@ -395,14 +752,15 @@ class Interceptor(SocksProxy):
         break
 #      print(3, [s.fileno() for s in rsl], [s.fileno() for s in wsl], S.recv_ready(), S.send_ready());
       # Wait for new data. .recv() will also process the data by fulfilling all completed futures
-      rs, ws, es = select.select(rsl, wsl, [], 1)
+      # SSL sockets may already have decrypted data which the event loop doesn't know about
+      pending = [s for s in rsl if hasattr(s, 'pending') and s.pending()]
+      rs, ws = await self.wait_io(rsl, wsl, poll=bool(pending))
+      rs = {*rs, *pending}
 #      print(4, [s.fileno() for s in rs], [s.fileno() for s in ws]);
       if S.socket in rs:
         S.recv()
       if C.socket in rs:
         C.recv()
-      C.check_timeouts()
-      S.check_timeouts()
       if S.socket in ws:
         S.flush_some()
       if C.socket in ws:
@@ -411,12 +769,9 @@ class Interceptor(SocksProxy):
       S.validate_silence()
 
     self.logger.info("Done with connection, can't intercept anything else here")
-    # Cancel any remaining protocol interceptors. There shouldn't be any, but just in case...
-    for PI in self.PIs:
-      PI.cancel()
 
   def start_interceptors(self, fname=None):
-    for name, mod in mods.items():
+    for name, mod in self.candidates.items():
       if fname is not None:
         if fname != name:
           continue
@@ -426,37 +781,109 @@ class Interceptor(SocksProxy):
 
   def handle_socks(self):
     self.logger.info(f'Socks5 connection established')
-    self.quit = False
-    loop = asyncio.new_event_loop()
-    asyncio.set_event_loop(loop)
-    self.S = S = ShadowProcessor(self, self.sdirect)
-    self.C = C = ShadowProcessor(self, self.connection)
+    if self.intercept(self.sdirect, self.connection, self.initial_data):
+      self.sdirect = None
+
+  async def run_interceptors(self, server, client, data, sdata=b''):
+    self.S = S = ShadowProcessor(self, server, args.intercept_window, args.intercept_recv_size)
+    self.C = C = ShadowProcessor(self, client, args.intercept_window, args.intercept_recv_size)
+    C.data.append(data)
+    S.data.append(sdata)
     S.D = C
     C.D = S
     self.PIs = set()
-    self.start_interceptors()
-    loop.run_until_complete(self.process_stuff(S, C))
-    loop.close()
-    toS = S.to_be_sent + C.data
-    toC = C.to_be_sent + S.data
-    C.data = b''
-    S.data = b''
-    if not self.quit:
-      pipe_sockets(S.socket, C.socket, toS, toC, logger=self.logger)
+    self.wakeup = None
+    try:
+      self.start_interceptors()
+      await self.process_stuff(S, C)
+    finally:
+      # Cancel any remaining protocol interceptors. There shouldn't be any, but just in case...
+      for PI in self.PIs:
+        PI.cancel()
+      S.close()
+      C.close()
+
+  # Reads from the client until it's clear which of the candidates' signatures its data starts with. If the server
+  # sends something first, or the client closes the connection, what was read so far has to do. Returns the data read
+  # from the client and the server, and the candidates left. Waits using poll, which unlike select handles descriptors
+  # beyond FD_SETSIZE, and unlike epoll doesn't take up one itself for every connection waiting here.
+  def read_signatures(self, server, client, data, candidates):
+    sdata = b''
+    final = False
+    with selectors.PollSelector() as selector:
+      selector.register(server, selectors.EVENT_READ)
+      selector.register(client, selectors.EVENT_READ)
+      while True:
+        matches = {name: signature_match(mod, data, final) for name, mod in candidates.items()}
+        if None not in matches.values():
+          return data, sdata, {name: mod for name, mod in candidates.items() if matches[name]}
+        rs = [client]
+        if not (hasattr(client, 'pending') and client.pending()):
+          rs = [key.fileobj for key, events in selector.select()]
+        try:
+          if client in rs:
+            res = client.recv(args.intercept_recv_size)
+            data += res
+          else:
+            # With TLS 1.3, the server sends session tickets after the handshake, which aren't data yet
+            res = sdata = server.recv(args.intercept_recv_size)
+        except (ssl.SSLWantReadError, ssl.SSLWantWriteError, BlockingIOError):
+          continue
+        if not res or sdata:
+          final = True
+
+  # Runs the interceptors which could make sense of the connection between client and server, and then relays the
+  # rest using relay. If there aren't any, it's relayed right away. host is the name the client connected to.
+  # The interceptors of all connections share one event loop, this thread only waits for them to be done.
+  # Returns False if the connection was quit instead.
+  def intercept(self, server, client, data=b'', relay=relay_sockets, host=None):
+    self.quit = False
+    if host is None:
+      host = self.remote_domain
+    server.setblocking(False)
+    client.setblocking(False)
+    sdata = b''
+    candidates = {name: mod for name, mod in mods.items() if prefilter(mod, self.remote_port, host)}
+    if candidates:
+      data, sdata, candidates = self.read_signatures(server, client, data, candidates)
+    for name in mods.keys() - candidates.keys():
+      metrics.inc(metrics.series('mitm_interceptor_outcomes_total', interceptor=name, outcome='skipped'))
+    if not candidates:
+      self.logger.info('No interceptor for this connection')
+      relay(server, client, data, sdata, logger=self.logger)
+      return True
+    self.candidates = candidates
+    asyncio.run_coroutine_threadsafe(self.run_interceptors(server, client, data, sdata), get_intercept_loop()).result()
+    S = self.S
+    C = self.C
+    toS = bytes(S.to_be_sent) + bytes(C.data)
+    toC = bytes(C.to_be_sent) + bytes(S.data)
+    C.data.clear()
+    S.data.clear()
+    if self.quit:
+      return False
+    relay(S.socket, C.socket, toS, toC, logger=self.logger)
+    return True
 
   def cleanup(self):
     if self.sdirect:
       self.sdirect.close()
 
 
+def add_interceptor_arguments(parser):
+  parser.add_argument('--intercept-window', type=int, default=1024 * 1024, help='maximum number of bytes of each side of a connection the interceptors can look at, reading from that side pauses while it is full')
+  parser.add_argument('--intercept-recv-size', type=int, default=64 * 1024, help='maximum number of bytes read from a socket at once while intercepting')
+
+
 if __name__ == '__main__':
   logging.root.setLevel(logging.NOTSET if os.environ.get('DEBUG') is not None else logging.INFO)
   setprocname(__file__)
   parser = argparse.ArgumentParser(description='socks <=> socks proxy for live traffic introspection, interception & manipulation', formatter_class=argparse.ArgumentDefaultsHelpFormatter)
   parser.add_argument('-l', '--listen', type=str2ipport(ad=False), help='IP:PORT to listen on', required=True)
   parser.add_argument('-c', '--via', type=str2ipport(), help='IP:PORT of socks proxy to connect to, or "direct" for none', required=True)
+  add_interceptor_arguments(parser)
+  add_server_arguments(parser)
   reload_all();
   signal.signal(signal.SIGHUP, sighup)
   args = parser.parse_args()
-  with ThreadingTCPServer(args.listen, Interceptor) as server:
-    server.serve_forever()
+  serve(args, Interceptor)
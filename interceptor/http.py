@@ -4,38 +4,52 @@ import os, subprocess, traceback
 from async_generator import aclosing
 
 data_processor = None
+DECODE_SIZE = 64 * 1024 # Maximum size of the decompressed chunks
+
+# Requests start with the method, which parse_first_request_line takes to be 3 to 10 of A-Z
+signatures = [bytes([x]) for x in range(65, 91)]
+
+# The first line & header lines are read in one go up to the line break, and then checked as a whole
+REQUEST_LINE  = re.compile(rb'([A-Z]{3,10}) ([\x21-\x7e]{1,2048}) HTTP/1\.([01])')
+RESPONSE_LINE = re.compile(rb'HTTP/1\.([01]) ([0-9]{1,3}) ([\x20-\x7e]{0,2048})')
+HEADER_LINE   = re.compile(rb'([\x21-\x7e][\x21-\x39\x3b-\x7e]{1,255}):([\x20-\x7e]{1,8192})')
+MAX_REQUEST_LINE  = 10 + 1 + 2048 + 9
+MAX_RESPONSE_LINE = 8 + 1 + 3 + 1 + 2048
+MAX_HEADER_LINE   = 256 + 1 + 8192
+
+LINE = PRINTABLE = HEX = None
 
 def init():
-  global data_processor
+  global data_processor, LINE, PRINTABLE, HEX
   data_processor = os.path.join(I.root, 'save_http_files.sh')
+  LINE      = I.charset(lambda x: x != 13 and x != 10) # Anything up to CR or LF
+  PRINTABLE = I.charset(lambda x: 32<=x<=126) # Any printable ascii character
+  HEX       = I.charset(lambda x: 48<=x<=57 or 65<=x<=90 or 97<=x<=122) # 0-9A-Za-z
+
+async def match_line(X, o, pattern, max):
+  o, line = await X.match_charset(o, LINE, min=0, max=max)
+  m = pattern.fullmatch(line)
+  if not m:
+    raise I.MismatchException()
+  o = await X.match_CRLF(o)
+  return o, m.groups()
 
 async def parse_first_request_line(self, o, C):
-  o, method   = await C.match(o, lambda x, i: 65<=x<=90, min=3, max=10) # A-Z
-  o, _        = await C.match(o, b' ')
-  o, location = await C.match(o, lambda x, i: 33<=x<=126, min=1, max=2048) # Any printable ascii character, excluding space
-  o, _        = await C.match(o, b' HTTP/1.')
-  o, version  = await C.match(o, lambda x, i: x == 48 or x == 49, max=1) # 0 or 1
-  o           = await C.match_CRLF(o)
+  o, (method, location, version) = await match_line(C, o, REQUEST_LINE, MAX_REQUEST_LINE)
   return o, method, location, b'HTTP/1.' + version
 
 async def parse_response_line(self, o, S):
-  o, _        = await S.match(o, b'HTTP/1.')
-  o, version  = await S.match(o, lambda x, i: x == 48 or x == 49, max=1) # 0 or 1
-  o, _        = await S.match(o, b' ')
-  o, code     = await S.match(o, lambda x, i: 48<=x<=57, min=1, max=3) # 0-9
-  o, _        = await S.match(o, b' ')
-  o, location = await S.match(o, lambda x, i: 32<=x<=126, min=0, max=2048) # Any printable ascii character
-  o           = await S.match_CRLF(o)
+  o, (version, code, location) = await match_line(S, o, RESPONSE_LINE, MAX_RESPONSE_LINE)
   return o, b'HTTP/1.' + version, int(code), location
 
 async def parse_header(self, o, X):
   header_value = None
   while True:
-    c = await X.read(o, 1, 1, consume=False); o += 1
+    c = await X.read(o, 1, 1, consume=False)
     if c == b' ':
-      X.consume(o)
+      X.consume(o + 1)
       assert header_value is not None
-      o, header_value_continuation = await X.match(o, lambda x, i: 32<=x<=126, min=1, max=1024 * 8 - len(header_value))
+      o, header_value_continuation = await X.match_charset(o + 1, PRINTABLE, min=1, max=1024 * 8 - len(header_value))
       header_value += header_value_continuation
       header_value_continuation = None
       o = await X.match_CRLF(o)
@@ -44,36 +58,35 @@ async def parse_header(self, o, X):
       header_value = header_value.strip()
       if header_value[0] == b'"'[0] and header_value[-1] == b'"'[0]:
         header_value = json.loads(header_value)
-      return o-1, (header_name, header_value)
-    X.consume(o)
+      return o, (header_name, header_value)
     if c == b'\r':
-      o, _ = await X.match(o, b'\n')
+      X.consume(o + 1)
+      o, _ = await X.match_literal(o + 1, b'\n')
       return o, None
     if c == b'\n':
-      return o, None
-    assert 33<=c[0]<=126
-    o, header_name = await X.match(o, lambda x, i: 33<=x<=126 and x != 58, min=1, max=255)
-    header_name = c + header_name
-    o, _ = await X.match(o, b':')
-    o, header_value = await X.match(o, lambda x, i: 32<=x<=126, min=1, max=1024 * 8)
-    o = await X.match_CRLF(o)
-
-async def read_content_length(self, X, o, remaining):
+      X.consume(o + 1)
+      return o + 1, None
+    o, (header_name, header_value) = await match_line(X, o, HEADER_LINE, MAX_HEADER_LINE)
+
+# Yields whatever part of the body has arrived so far, up to the whole window at once. Nothing if it's skipped.
+async def read_content_length(self, X, o, remaining, skip=False):
+  if skip:
+    o[0] = await X.skip(o[0], remaining)
+    return
   while remaining > 0:
-    chunk_size = min(remaining, 4096)
-    chunk = await X.read(o[0], chunk_size, chunk_size)
+    chunk = await X.read(o[0], 1, min(remaining, X.SP.window))
     remaining -= len(chunk)
     o[0] += len(chunk)
     yield chunk
 
-async def read_chunks(self, X, o):
+async def read_chunks(self, X, o, skip=False):
   while True:
-    o[0], remaining = await X.match(o[0], lambda x, i: 48<=x<=57 or 65<=x<=90 or 97<=x<=122, min=1, max=8) # 0-9A-Za-z
+    o[0], remaining = await X.match_charset(o[0], HEX, min=1, max=8)
     remaining = int(remaining, 16)
     o[0] = await X.match_CRLF(o[0])
     if remaining == 0:
       break
-    async for chunk in read_content_length(self, X, o, remaining):
+    async for chunk in read_content_length(self, X, o, remaining, skip):
       yield chunk
     o[0] = await X.match_CRLF(o[0])
 
@@ -84,7 +97,7 @@ def decode_gzip(reader):
     decoder = zlib.decompressobj(zlib.MAX_WBITS|16)
     async for chunk in reader():
       while len(chunk) != 0:
-        yield decoder.decompress(chunk, max_length=4096)
+        yield decoder.decompress(chunk, max_length=DECODE_SIZE)
         chunk = decoder.unconsumed_tail
     if not decoder.eof:
       raise I.ProtocolValidationException("gzip compressed data incomplete")
@@ -95,7 +108,7 @@ def decode_deflate(reader):
     decoder = zlib.decompressobj(-zlib.MAX_WBITS)
     async for chunk in reader():
       while len(chunk) != 0:
-        yield decoder.decompress(chunk, max_length=4096)
+        yield decoder.decompress(chunk, max_length=DECODE_SIZE)
         chunk = decoder.unconsumed_tail
     if not decoder.eof:
       raise I.ProtocolValidationException("deflate compressed data incomplete")
@@ -116,7 +129,8 @@ decoders = {
   b'br'     : decode_brotli,
 }
 
-async def read_response_content(self, S, o, stransfer_encoding, scontent_encoding, scontent_length, has_trailer):
+# If skip is set, the body is only followed to its end, but not read or decoded
+async def read_response_content(self, S, o, stransfer_encoding, scontent_encoding, scontent_length, has_trailer, skip=False):
 
   chunked = False
   has_trailer[0] = False
@@ -129,19 +143,21 @@ async def read_response_content(self, S, o, stransfer_encoding, scontent_encodin
 
   async def read_response_content_sub():
     if chunked:
-      async for chunk in read_chunks(self, S, o):
+      async for chunk in read_chunks(self, S, o, skip):
         yield chunk
     elif scontent_length:
-      async for chunk in read_content_length(self, S, o, scontent_length):
+      async for chunk in read_content_length(self, S, o, scontent_length, skip):
         yield chunk
+    elif skip:
+      o[0] = await S.skip(o[0])
     else:
       while not S.SP.EOF:
-        chunk = await S.read(o[0], 1, 4096)
+        chunk = await S.read(o[0], 1, S.SP.window)
         o[0] += len(chunk)
         yield chunk
 
   reader = read_response_content_sub
-  for encoding in [*stransfer_encoding, *scontent_encoding]:
+  for encoding in [] if skip else [*stransfer_encoding, *scontent_encoding]:
     encoding = encoding.lower()
     if encoding == 'identity':
       continue
@@ -193,12 +209,8 @@ async def intercept(self, C, S):
 
   #  self.logger.info(('All headers:', request_headers))
 
-    _Co=[Co]
-    async with aclosing(read_content_length(self, C, _Co, ccontent_length)) as ag:
-      async for chunk in ag:
-        pass
-#        print(b'    ',chunk)
-    Co = _Co[0]
+    # Request bodies aren't looked at
+    Co = await C.skip(Co, ccontent_length)
 
     ### RESPONSE ###
     C.expect_silence(True)
@@ -261,11 +273,12 @@ async def intercept(self, C, S):
 
       _So = [So]
       has_trailer = [0]
-      async with aclosing(read_response_content(self, S, _So, stransfer_encoding, scontent_encoding, scontent_length, has_trailer)) as ag:
+      # Without anything to pass the body to, it doesn't need to be read at all
+      async with aclosing(read_response_content(self, S, _So, stransfer_encoding, scontent_encoding, scontent_length, has_trailer, skip=dp is None)) as ag:
         async for chunk in ag:
           if dp:
             try:
-              dp.stdin.write(chunk)
+              await self.write(dp.stdin, chunk)
             except:
               traceback.print_exc()
               dp = None
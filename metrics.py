@@ -0,0 +1,190 @@
+import os, json, time
+import socket, threading, weakref
+from collections import defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from socketserver import ThreadingUnixStreamServer
+
+# Each thread updates its own counters, so updating them is just a dict lookup & addition without any locking.
+# They are only summed up when the metrics are requested.
+
+BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10)
+
+descriptions = {}
+collectors = []
+
+enabled = False
+lock = threading.Lock()
+local = threading.local()
+thread_counters = []
+finished = defaultdict(int) # Counters of threads which don't exist anymore
+discarded = defaultdict(int) # Used while the metrics are disabled
+
+def counters():
+  if not enabled:
+    return discarded
+  try:
+    return local.counters
+  except AttributeError:
+    c = local.counters = defaultdict(int)
+    with lock:
+      if len(thread_counters) >= 1024:
+        fold()
+      thread_counters.append((weakref.ref(threading.current_thread()), c))
+    return c
+
+# Merges the counters of threads which exited into finished, and returns the items of the others. Must hold the lock.
+def fold():
+  global thread_counters
+  alive = []
+  result = []
+  for thread, c in thread_counters:
+    while True:
+      try:
+        items = list(c.items())
+        break
+      except RuntimeError: # Changed size during iteration
+        pass
+    t = thread()
+    if t is None or not t.is_alive():
+      for k, v in items:
+        finished[k] += v
+    else:
+      alive.append((thread, c))
+      result += items
+  thread_counters = alive
+  return result
+
+def describe(name, kind, help):
+  descriptions[name] = (kind, help)
+
+def series(name, **labels):
+  if not labels:
+    return name
+  return name + '{' + ','.join(f'{k}="{v}"' for k, v in labels.items()) + '}'
+
+def inc(name, value=1):
+  counters()[name] += value
+
+def observe(name, seconds, **labels):
+  c = counters()
+  for le in BUCKETS:
+    if seconds <= le:
+      c[series(name + '_bucket', **labels, le=le)] += 1
+  c[series(name + '_bucket', **labels, le='+Inf')] += 1
+  c[series(name + '_count', **labels)] += 1
+  c[series(name + '_sum', **labels)] += seconds
+
+class Timer:
+  def __init__(self, name, **labels):
+    self.name = name
+    self.labels = labels
+
+  def __enter__(self):
+    self.start = time.monotonic()
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    if exc_type is None:
+      observe(self.name, time.monotonic() - self.start, **self.labels)
+
+def snapshot():
+  result = defaultdict(int)
+  with lock:
+    for k, v in fold():
+      result[k] += v
+    for k, v in finished.items():
+      result[k] += v
+  for collector in collectors:
+    for k, v in collector().items():
+      result[k] += v
+  return result
+
+def prometheus():
+  values = snapshot()
+  out = []
+  done = set()
+  for key in sorted(values):
+    name = key.split('{', 1)[0]
+    base = name
+    for suffix in ('_bucket', '_count', '_sum'):
+      if name.endswith(suffix) and name[:-len(suffix)] in descriptions:
+        base = name[:-len(suffix)]
+    if base not in done and base in descriptions:
+      done.add(base)
+      kind, help = descriptions[base]
+      out.append(f'# HELP {base} {help}')
+      out.append(f'# TYPE {base} {kind}')
+    out.append(f'{key} {values[key]}')
+  return '\n'.join(out) + '\n'
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+  def do_GET(self):
+    if self.path == '/metrics':
+      body = prometheus().encode()
+      ctype = 'text/plain; version=0.0.4'
+    elif self.path == '/metrics.json':
+      body = json.dumps(snapshot(), sort_keys=True).encode()
+      ctype = 'application/json'
+    else:
+      self.send_error(404)
+      return
+    self.send_response(200)
+    self.send_header('Content-Type', ctype)
+    self.send_header('Content-Length', str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+  def address_string(self):
+    return str(self.client_address[0]) if self.client_address else 'unix'
+
+  def log_message(self, format, *args):
+    pass
+
+
+class HTTPServer(ThreadingHTTPServer):
+  daemon_threads = True
+
+
+class HTTP6Server(HTTPServer):
+  address_family = socket.AF_INET6
+
+
+class UnixHTTPServer(ThreadingUnixStreamServer):
+  daemon_threads = True
+
+  def get_request(self):
+    request, client_address = super().get_request()
+    return request, ('unix', 0)
+
+
+# address is either (ip, port) or a path to a unix socket
+def start_server(address):
+  global enabled
+  enabled = True
+  if isinstance(address, str):
+    try:
+      os.unlink(address)
+    except FileNotFoundError:
+      pass
+    server = UnixHTTPServer(address, MetricsHandler)
+  else:
+    server = (HTTP6Server if ':' in address[0] else HTTPServer)(address, MetricsHandler)
+  threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+  return server
+
+
+describe('mitm_connections_total', 'counter', 'Accepted connections')
+describe('mitm_relays_active', 'gauge', 'Connections currently being relayed by pipe_sockets or the relay loop')
+describe('mitm_relay_bytes_total', 'counter', 'Bytes relayed, upstream is from the client to the remote')
+describe('mitm_socks_handshake_seconds', 'histogram', 'Time from accepting a connection until the socks connect request was received')
+describe('mitm_via_connect_seconds', 'histogram', 'Time for connecting to the remote, kind is direct, socks, or pooled for connections from the --via-pool')
+describe('mitm_tls_handshake_seconds', 'histogram', 'TLS handshake time, side is the role of this proxy. On the server side, it includes forging the certificate if it isn\'t cached yet')
+describe('mitm_tls_sessions_total', 'counter', 'TLS handshakes by whether a session was resumed. On the client side, rejected means a cached session was offered but not accepted')
+describe('mitm_cert_generation_seconds', 'histogram', 'Time for forging a certificate')
+describe('mitm_cert_cache_total', 'counter', 'Forged certificate lookups, result is hit, pending for ones already being forged for another connection, shared for ones forged by another worker, store for ones loaded from the --cert-store, or miss')
+describe('mitm_cert_key_pool_empty_total', 'counter', 'Keys generated while forging a certificate because the --cert-key-pool was empty')
+describe('mitm_dns_cache_total', 'counter', 'Lookups of domains connected to directly')
+describe('mitm_interceptor_outcomes_total', 'counter', 'Outcomes of protocol interceptors')
+describe('mitm_interceptor_bytes_total', 'counter', 'Bytes received by the interceptor shadow processors')
+describe('mitm_server_connections', 'gauge', 'Handler pool state')
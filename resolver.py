@@ -0,0 +1,151 @@
+import os, time, errno, logging
+import select, socket, threading
+import metrics
+from singleflight import Pending
+
+# RFC 8305 section 5, how long to wait for a connection attempt before starting the next one in parallel
+CONNECT_ATTEMPT_DELAY = 0.25
+# Otherwise, an address which doesn't answer would keep the connection waiting until the kernel gives up on it
+CONNECT_TIMEOUT = 30
+
+
+def is_address(host):
+  for family in (socket.AF_INET, socket.AF_INET6):
+    try:
+      socket.inet_pton(family, host)
+      return True
+    except OSError:
+      pass
+  return False
+
+
+# getaddrinfo doesn't tell us the TTL of the records, so the results are kept for a fixed time.
+# Concurrent lookups of the same name share a single getaddrinfo call.
+class Resolver:
+  def __init__(self, ttl=60, negative_ttl=5, connect_timeout=CONNECT_TIMEOUT, getaddrinfo=socket.getaddrinfo):
+    self.ttl = ttl
+    self.negative_ttl = negative_ttl
+    self.connect_timeout = connect_timeout
+    self.getaddrinfo = getaddrinfo
+    self.cache = {}
+    self.lookups = {}
+    self.lock = threading.Lock()
+
+  # Returns a list of (family, sockaddr) tuples, in the order they should be tried
+  def resolve(self, host):
+    with self.lock:
+      entry = self.cache.get(host)
+      if entry and entry[0] > time.monotonic():
+        result = entry[1]
+        lookup = None
+        metrics.inc(metrics.series('mitm_dns_cache_total', result='hit' if isinstance(result, list) else 'negative'))
+      else:
+        lookup = self.lookups.get(host)
+        owner = lookup is None
+        if owner:
+          lookup = self.lookups[host] = Pending()
+          metrics.inc(metrics.series('mitm_dns_cache_total', result='miss'))
+    if lookup and not owner:
+      result = lookup.wait()
+    elif lookup:
+      try:
+        result = interleave(self.getaddrinfo(host, None, socket.AF_UNSPEC, socket.SOCK_STREAM))
+        ttl = self.ttl
+      except socket.gaierror as e:
+        result = (type(e), e.args)
+        ttl = self.negative_ttl
+      except:
+        with self.lock:
+          del self.lookups[host]
+        lookup.set((socket.gaierror, (socket.EAI_FAIL, 'Lookup failed')))
+        raise
+      with self.lock:
+        if ttl > 0:
+          self.cache[host] = (time.monotonic() + ttl, result)
+        del self.lookups[host]
+        if len(self.cache) > 4096:
+          self.expire()
+      lookup.set(result)
+    if not isinstance(result, list):
+      raise result[0](*result[1])
+    return result
+
+  # Must hold the lock
+  def expire(self):
+    now = time.monotonic()
+    for host in [host for host, entry in self.cache.items() if entry[0] <= now]:
+      del self.cache[host]
+
+  def connect(self, host, port, logger=logging):
+    return connect(self.resolve(host), port, timeout=self.connect_timeout, logger=logger)
+
+
+# RFC 8305 section 4, alternate between the address families, starting with the one getaddrinfo preferred
+def interleave(infos):
+  families = {}
+  for family, type, proto, canonname, sockaddr in infos:
+    addresses = families.setdefault(family, [])
+    if (family, sockaddr) not in addresses:
+      addresses.append((family, sockaddr))
+  result = []
+  queues = list(families.values())
+  while queues:
+    for q in queues:
+      result.append(q.pop(0))
+    queues = [q for q in queues if q]
+  return result
+
+
+# Happy eyeballs. Starts a new connection attempt every CONNECT_ATTEMPT_DELAY seconds, or as soon as one fails,
+# until one succeeds, or timeout seconds have passed. Returns the connected socket in blocking mode.
+def connect(addresses, port, delay=CONNECT_ATTEMPT_DELAY, timeout=CONNECT_TIMEOUT, logger=logging):
+  addresses = list(addresses)
+  attempts = {}
+  error = None
+  next_attempt = 0
+  deadline = time.monotonic() + timeout
+  try:
+    while addresses or attempts:
+      now = time.monotonic()
+      if now >= deadline:
+        raise TimeoutError(errno.ETIMEDOUT, f'Connecting to port {port} timed out after {timeout} s')
+      if addresses and now >= next_attempt:
+        family, sockaddr = addresses.pop(0)
+        sockaddr = (sockaddr[0], port) + tuple(sockaddr[2:])
+        s = socket.socket(family, socket.SOCK_STREAM)
+        s.setblocking(False)
+        res = s.connect_ex(sockaddr)
+        if res == 0:
+          s.setblocking(True)
+          return s
+        if res != errno.EINPROGRESS:
+          error = OSError(res, os.strerror(res), sockaddr[0])
+          logger.debug(f'Connecting to {sockaddr[0]} :{port} failed: {error}')
+          s.close()
+          continue
+        attempts[s] = sockaddr
+        next_attempt = now + delay
+      wait = deadline - now
+      if addresses:
+        wait = min(wait, max(next_attempt - now, 0))
+      # Unlike select, poll handles descriptors beyond FD_SETSIZE
+      poller = select.poll()
+      fds = {}
+      for s in attempts:
+        fds[s.fileno()] = s
+        poller.register(s, select.POLLOUT)
+      for fd, events in poller.poll(wait * 1000):
+        s = fds[fd]
+        sockaddr = attempts.pop(s)
+        res = s.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if res == 0:
+          s.setblocking(True)
+          return s
+        error = OSError(res, os.strerror(res), sockaddr[0])
+        logger.debug(f'Connecting to {sockaddr[0]} :{port} failed: {error}')
+        s.close()
+        next_attempt = 0
+    raise error or OSError(errno.EHOSTUNREACH, 'No addresses to connect to')
+  finally:
+    for s in attempts:
+      s.close()
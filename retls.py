@@ -1,23 +1,107 @@
 #!/usr/bin/env python3
 
+import time
 import logging
 import argparse
+import threading, collections
+import metrics
 import ssl, select, socket, struct, random
-from socksproxy import SocksProxy, ThreadingTCPServer, pipe_sockets, str2ipport, setprocname
+from socksproxy import SocksProxy, ThreadingTCPServer, pipe_sockets, relay_sockets, str2ipport, setprocname, add_server_arguments, serve, enable_ktls
 from socketserver import ThreadingMixIn, TCPServer, StreamRequestHandler
 
 
+# Sessions of previous connections, so the next connection to the same server can resume them
+class SessionCache:
+  def __init__(self, size=1024):
+    self.size = size
+    self.sessions = collections.OrderedDict() # Least recently used first
+    self.lock = threading.Lock()
+
+  def get(self, key):
+    with self.lock:
+      session = self.sessions.get(key)
+      if session is None:
+        return None
+      if time.time() >= session.time + session.timeout:
+        del self.sessions[key]
+        return None
+      self.sessions.move_to_end(key)
+      return session
+
+  def put(self, key, session):
+    with self.lock:
+      self.sessions[key] = session
+      self.sessions.move_to_end(key)
+      while len(self.sessions) > self.size:
+        self.sessions.popitem(last=False)
+
+  def discard(self, key):
+    with self.lock:
+      self.sessions.pop(key, None)
+
+
+sessions = SessionCache()
+
+
+# With TLS 1.3, the session tickets only arrive after the handshake, so the session is remembered when the connection is closed
+class SessionSocket(ssl.SSLSocket):
+  session_key = None
+
+  def remember_session(self):
+    session = self.session
+    if self.session_key is None or session is None:
+      return
+    # TLS 1.3 sessions without a ticket can't be resumed
+    if session.has_ticket or (session.id and self.version() != 'TLSv1.3'):
+      sessions.put(self.session_key, session)
+    self.session_key = None
+
+  def unwrap(self):
+    self.remember_session()
+    return super().unwrap()
+
+  def close(self):
+    self.remember_session()
+    super().close()
+
+
+def create_context(ktls=False):
+  context = ssl.create_default_context(ssl.Purpose.SERVER_AUTH)
+  if ktls:
+    enable_ktls(context)
+  context.set_alpn_protocols([])
+  context.sslsocket_class = SessionSocket
+  return context
+
+
 class ReTLS(SocksProxy):
   def remote_connect(self):
     self.logger.info(f'Connecting to remote {self.remote_domain} :{self.remote_port} via {self.remote_address}')
-    with self.mksocket(args.via) as s:
-      ssock = context.wrap_socket(s, server_hostname=self.remote_domain)
-      self.rconnect(ssock, args.via)
-      self.sdirect = ssock
+    self.sdirect = self.tls_connect(args.via, self.remote_domain)
+
+  def tls_connect(self, via, hostname):
+    key = (hostname, self.remote_address, self.remote_port)
+    session = sessions.get(key)
+    with self.rconnect(self.mksocket(via), via, hostname) as s:
+      with metrics.Timer('mitm_tls_handshake_seconds', side='client'):
+        try:
+          ssock = context.wrap_socket(s, server_hostname=hostname, session=session)
+        except ssl.SSLError:
+          if session is not None: # Don't offer it again if that's what went wrong
+            sessions.discard(key)
+          raise
+    if session is None:
+      result = 'miss'
+    else:
+      result = 'hit' if ssock.session_reused else 'rejected'
+    metrics.inc(metrics.series('mitm_tls_sessions_total', side='client', result=result))
+    ssock.session_key = key
+    return ssock
 
   def handle_socks(self):
     self.logger.info(f'Socks5 connection established')
-    pipe_sockets(self.sdirect, self.connection, logger=self.logger)
+    relay_sockets(self.sdirect, self.connection, self.initial_data, logger=self.logger)
+    self.sdirect = None
 
   def cleanup(self):
     if self.sdirect:
@@ -30,8 +114,8 @@ if __name__ == '__main__':
   parser = argparse.ArgumentParser(description='socks plain to tls proxy', formatter_class=argparse.ArgumentDefaultsHelpFormatter)
   parser.add_argument('-l', '--listen', type=str2ipport('127.0.0.1', 3666, False), help='IP:PORT to listen on', default='127.0.0.1:3666')
   parser.add_argument('-c', '--via', type=str2ipport(), help='IP:PORT of socks proxy to connect to, or "direct" for none', default='direct')
+  parser.add_argument('--ktls', action='store_true', help='let the kernel encrypt the traffic to the servers where possible, falls back to OpenSSL if it can\'t')
+  add_server_arguments(parser)
   args = parser.parse_args()
-  context = ssl.create_default_context(ssl.Purpose.SERVER_AUTH)
-  context.set_alpn_protocols([])
-  with ThreadingTCPServer(args.listen, ReTLS) as server:
-    server.serve_forever()
+  context = create_context(args.ktls)
+  serve(args, ReTLS)
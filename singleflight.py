@@ -0,0 +1,16 @@
+import threading
+
+
+# The result of some work which other threads wanting the same thing wait for, instead of doing it again themselves
+class Pending:
+  def __init__(self):
+    self.done = threading.Event()
+    self.result = None
+
+  def set(self, result):
+    self.result = result
+    self.done.set()
+
+  def wait(self):
+    self.done.wait()
+    return self.result
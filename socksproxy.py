@@ -2,11 +2,14 @@
 
 import re
 import logging
-import ctypes, os, sys, errno
+import ctypes, os, sys, errno, fcntl
 import traceback, argparse
 import select, socket, socks, struct, random
-import ssl
+import ssl, asyncio, threading, queue
+import signal, time, multiprocessing, collections
 from socketserver import ThreadingMixIn, TCPServer, StreamRequestHandler
+import metrics
+from resolver import Resolver, is_address
 
 
 SOCKS_VERSION = 5
@@ -14,6 +17,28 @@ SO_ORIGINAL_DST = 80
 SOL_IPV6 = 41
 IP6T_SO_ORIGINAL_DST = 80
 
+F_SETPIPE_SZ = 1031
+SOL_TLS = 282
+TLS_TX = 1
+TCP_ULP = 31
+# Python only has it since 3.12, but OpenSSL 3 knows it anyway
+OP_ENABLE_KTLS = getattr(ssl, 'OP_ENABLE_KTLS', 1 << 3 if ssl.OPENSSL_VERSION_INFO >= (3,) else 0)
+
+relay_loop = None
+connection_counter = None # Shared between worker processes
+via_pool_size = 0
+via_pool_idle = 30
+via_pools = {}
+via_pools_lock = threading.Lock()
+use_splice = hasattr(os, 'splice')
+ktls_available = None
+relay_buffer_size = 16 * 4096
+reject_timeout = 1 # Seconds a rejected connection gets to complete its socks handshake
+dns_cache = Resolver()
+
+BYTES_UP = metrics.series('mitm_relay_bytes_total', direction='upstream')
+BYTES_DOWN = metrics.series('mitm_relay_bytes_total', direction='downstream')
+
 def setprocname(file):
   name = os.path.basename(file)
   ctypes.CDLL(None).prctl(15, name.encode(), 0, 0, 0)
@@ -41,33 +66,316 @@ def str2ipport(addr=None, dport=None, ad=True):
   return parse
 
 class ThreadingTCPServer(ThreadingMixIn, TCPServer):
-  def __init__(self, server_address, RequestHandlerClass, bind_and_activate=True):
+  def __init__(self, server_address, RequestHandlerClass, bind_and_activate=True, max_handlers=0, max_queued=0, max_per_client=0, reuse_port=False):
+    self.reuse_port = reuse_port
     self.address_family = socket.AF_INET if re.fullmatch('(25[0-5]|2[0-4][0-9]|[01]?[0-9][0-9]?)(\\.(25[0-5]|2[0-4][0-9]|[01]?[0-9][0-9]?)){3}', server_address[0]) else socket.AF_INET6
+    # max_handlers == 0 means a new thread for every connection, as ThreadingMixIn does it
+    self.max_handlers = max_handlers
+    self.max_queued = max_queued
+    self.max_per_client = max_per_client
+    self.lock = threading.Lock()
+    self.clients = {}
+    self.active = 0
+    self.queued = 0
+    self.rejected = 0
+    self.rejecting = {} # Rejected connections being answered, and until when they have time for that
+    self.requests = queue.Queue()
+    # Rejected connections still get a proper socks reply, but there is only one thread for doing that
+    self.reject_queue = queue.Queue(64)
     super().__init__(server_address, RequestHandlerClass, bind_and_activate)
+    for i in range(max_handlers):
+      threading.Thread(target=self.worker, name=f'handler{i}', daemon=True).start()
+    if max_handlers or max_per_client:
+      threading.Thread(target=self.rejector, name='rejector', daemon=True).start()
+
+  def server_bind(self):
+    if self.reuse_port:
+      self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    super().server_bind()
+
+  def counters(self):
+    return {
+      'active': self.active,
+      'queued': self.queued,
+      'rejected': self.rejected,
+    }
+
+  def admit(self, client_address):
+    ip = client_address[0]
+    with self.lock:
+      if self.max_per_client and self.clients.get(ip, 0) >= self.max_per_client:
+        return False
+      if self.max_handlers and self.active + self.queued >= self.max_handlers + self.max_queued:
+        return False
+      self.clients[ip] = self.clients.get(ip, 0) + 1
+      if self.max_handlers:
+        self.queued += 1
+      else:
+        self.active += 1
+      return True
+
+  def release_client(self, client_address):
+    ip = client_address[0]
+    with self.lock:
+      n = self.clients[ip] - 1
+      if n:
+        self.clients[ip] = n
+      else:
+        del self.clients[ip]
+
+  def process_request(self, request, client_address):
+    if not self.admit(client_address):
+      self.rejected += 1
+      logging.warning(f'Rejecting connection from {client_address[0]} :{client_address[1]} {self.counters()}')
+      try:
+        self.reject_queue.put_nowait((request, client_address))
+      except queue.Full:
+        request.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack('ii', 1, 0))
+        self.shutdown_request(request)
+      return
+    if not self.max_handlers:
+      return super().process_request(request, client_address)
+    self.requests.put((request, client_address))
+
+  def process_request_thread(self, request, client_address):
+    try:
+      super().process_request_thread(request, client_address)
+    finally:
+      with self.lock:
+        self.active -= 1
+      # The handler is done, but the connection may still be alive in the relay loop
+      if relay_loop:
+        relay_loop.when_closed(request, lambda: self.release_client(client_address))
+      else:
+        self.release_client(client_address)
+
+  def worker(self):
+    while True:
+      request, client_address = self.requests.get()
+      with self.lock:
+        self.queued -= 1
+        self.active += 1
+      self.process_request_thread(request, client_address)
+
+  def rejector(self):
+    while True:
+      request, client_address = self.reject_queue.get()
+      self.rejecting[request] = time.monotonic() + reject_timeout
+      try:
+        request.settimeout(reject_timeout)
+        self.finish_request(request, client_address)
+      except:
+        pass
+      finally:
+        del self.rejecting[request]
+        self.shutdown_request(request)
+
+  def shutdown_request(self, request):
+    # The connection was handed over to the relay loop, which will close it once it's done
+    if relay_loop and relay_loop.owns(request):
+      return
+    super().shutdown_request(request)
 ThreadingTCPServer.allow_reuse_address = True
 
+# A connection to a socks proxy, for which the method selection has already been done.
+# Only the connect request is left to be sent.
+class GreetedSocket(socket.socket):
+  def greet(self, via):
+    super().connect(via)
+    self.sendall(struct.pack("!BBB", SOCKS_VERSION, 1, 0))
+    version, method = struct.unpack("!BB", self.recv_exact(2))
+    assert version == SOCKS_VERSION
+    if method != 0:
+      raise ConnectionError(f'socks proxy {via[0]}:{via[1]} refused authentication method')
+
+  def recv_exact(self, n):
+    buf = b''
+    while len(buf) < n:
+      res = self.recv(n - len(buf))
+      if not res:
+        raise ConnectionError('socks proxy closed the connection')
+      buf += res
+    return buf
+
+  def connect(self, address):
+    host, port = address
+    try:
+      rawaddr = struct.pack("!B", 1) + socket.inet_pton(socket.AF_INET, host)
+    except OSError:
+      try:
+        rawaddr = struct.pack("!B", 4) + socket.inet_pton(socket.AF_INET6, host)
+      except OSError:
+        host = host.encode()
+        rawaddr = struct.pack("!BB", 3, len(host)) + host
+    self.sendall(struct.pack("!BBB", SOCKS_VERSION, 1, 0) + rawaddr + struct.pack("!H", port))
+    version, rep, _, address_type = struct.unpack("!BBBB", self.recv_exact(4))
+    assert version == SOCKS_VERSION
+    if address_type == 1:
+      self.recv_exact(4 + 2)
+    elif address_type == 4:
+      self.recv_exact(16 + 2)
+    elif address_type == 3:
+      self.recv_exact(ord(self.recv_exact(1)) + 2)
+    else:
+      raise ConnectionError("Unsupported socks address type")
+    if rep != 0:
+      raise ConnectionError(f'socks proxy connect request failed with error {rep}')
+
+
+class ViaPool:
+  def __init__(self, via, size, idle):
+    self.via = via
+    self.size = size
+    self.idle = idle
+    self.sockets = collections.deque()
+    self.wanted = threading.Event()
+    self.thread = threading.Thread(target=self.fill, name=f'pool {via[0]}:{via[1]}', daemon=True)
+    self.thread.start()
+
+  def alive(self, s):
+    # The proxy isn't supposed to send anything before the connect request. If the socket is readable, it's probably closed.
+    rs, ws = select_sockets([s], [], 0)
+    return not rs
+
+  def get(self):
+    self.wanted.set()
+    while True:
+      try:
+        s, t = self.sockets.popleft()
+      except IndexError:
+        return None
+      if time.monotonic() - t < self.idle and self.alive(s):
+        return s
+      s.close()
+
+  def expire(self):
+    now = time.monotonic()
+    for i in range(len(self.sockets)):
+      try:
+        s, t = self.sockets.popleft()
+      except IndexError:
+        break
+      if now - t < self.idle and self.alive(s):
+        self.sockets.append((s, t))
+      else:
+        s.close()
+
+  def fill(self):
+    while True:
+      self.expire()
+      while len(self.sockets) < self.size:
+        s = GreetedSocket(socket.AF_INET6 if ':' in self.via[0] else socket.AF_INET)
+        try:
+          s.greet(self.via)
+        except Exception as e:
+          s.close()
+          logging.warning(f'Failed to pre-connect to socks proxy {self.via[0]}:{self.via[1]}: {e}')
+          break
+        self.sockets.append((s, time.monotonic()))
+      self.wanted.wait(min(self.idle / 2, 5))
+      self.wanted.clear()
+
+
+def get_via_pool(via):
+  if not via_pool_size:
+    return None
+  with via_pools_lock:
+    pool = via_pools.get(via)
+    if not pool:
+      pool = via_pools[via] = ViaPool(via, via_pool_size, via_pool_idle)
+    return pool
+
+
 class SocksProxy(StreamRequestHandler):
   def mksocket(self, via):
     if not via:
       return socket.socket(self.remote_family)
     else:
+      pool = get_via_pool(via)
+      if pool:
+        s = pool.get()
+        if s:
+          return s
       s = socks.socksocket()
       s.set_proxy(socks.SOCKS5, via[0], via[1])
       return s
 
+  # Returns the connected socket, which isn't necessarily s
   def rconnect(self, s, via, domain=None):
     if domain is None:
       domain = self.remote_domain
-    if not via or self.remote_address == domain:
-      s.connect((self.remote_address, self.remote_port))
+    kind = 'pooled' if isinstance(s, GreetedSocket) else 'socks' if getattr(s, 'proxy', (None,))[0] else 'direct'
+    with metrics.Timer('mitm_via_connect_seconds', kind=kind):
+      if not via and not is_address(self.remote_address):
+        s.close()
+        return dns_cache.connect(self.remote_address, self.remote_port, logger=self.logger)
+      if not via or self.remote_address == domain:
+        s.connect((self.remote_address, self.remote_port))
+      else:
+        s.connect((domain+'>'+self.remote_address, self.remote_port))
+      return s
+
+  # Returns the next n bytes of the socks handshake. Reads as much as is available, the client may
+  # already have sent the next request or even the first data for the remote.
+  def socks_read(self, n):
+    while len(self.socks_buf) - self.socks_offset < n:
+      # Rejected connections are answered one after another, a slow client mustn't hold up the others
+      if self.deadline is not None:
+        remaining = self.deadline - time.monotonic()
+        if remaining <= 0:
+          raise TimeoutError('socks handshake took too long')
+        self.connection.settimeout(remaining)
+      res = self.connection.recv(4096)
+      if not res:
+        raise EOFError()
+      self.socks_buf += res
+    res = self.socks_buf[self.socks_offset:self.socks_offset+n]
+    self.socks_offset += n
+    return res
+
+  def read_socks_request(self):
+    self.socks_buf = b''
+    self.socks_offset = 0
+
+    version, nmethods = struct.unpack("!BB", self.socks_read(2))
+    assert version == SOCKS_VERSION
+    assert nmethods > 0
+    methods = self.socks_read(nmethods)
+    assert 0 in methods
+    self.connection.sendall(struct.pack("!BB", SOCKS_VERSION, 0))
+
+    version, cmd, _, address_type = struct.unpack("!BBBB", self.socks_read(4))
+    assert version == SOCKS_VERSION
+    assert cmd == 1 # Only allow connect
+
+    if address_type == 1:  # ipv4
+      rawaddr = self.socks_read(4)
+      self.remote_address = socket.inet_ntop(socket.AF_INET, rawaddr)
+    elif address_type == 4:  # ipv6
+      rawaddr = self.socks_read(16)
+      self.remote_address = socket.inet_ntop(socket.AF_INET6, rawaddr)
+      self.remote_family = socket.AF_INET6
+    elif address_type == 3:  # domain
+      rawaddr = self.socks_read(1)
+      self.remote_address = self.socks_read(rawaddr[0])
+      rawaddr = rawaddr + self.remote_address
+      self.remote_address = self.remote_address.decode()
     else:
-      s.connect((domain+'>'+self.remote_address, self.remote_port))
+      raise Exception("Unsupported socks address type")
+    self.remote_port = struct.unpack('!H', self.socks_read(2))[0]
+
+    # Anything after the connect request is already data for the remote
+    self.initial_data = self.socks_buf[self.socks_offset:]
+    self.socks_buf = None
+    return address_type, rawaddr
 
   def handle(self):
     self.sdirect = None
+    self.remote_address = None
+    self.initial_data = b''
     self.remote_family = socket.AF_INET
-    SocksProxy.id = SocksProxy.id + 1
-    self.id = SocksProxy.id
+    self.id = next_connection_id()
+    metrics.inc('mitm_connections_total')
     self.logger = logging.getLogger(f's{self.id}')
     self.logger.info(f'Accepting connection from {self.client_address[0]} :{self.client_address[1]}')
 
@@ -99,6 +407,13 @@ class SocksProxy(StreamRequestHandler):
       pass
 
     self.remote_domain = self.remote_address
+    self.deadline = getattr(self.server, 'rejecting', {}).get(self.request)
+    reject = self.deadline is not None
+
+    if transparent and reject:
+      self.connection.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack('ii', 1, 0))
+      self.logger.info(f'done')
+      return
 
     if transparent:
       assert self.remote_address
@@ -114,34 +429,12 @@ class SocksProxy(StreamRequestHandler):
         self.logger.info(f'done')
       return
 
-    header = self.connection.recv(2)
-    version, nmethods = struct.unpack("!BB", header)
-    assert version == SOCKS_VERSION
-    assert nmethods > 0
-    methods = [ord(self.connection.recv(1)) for i in range(nmethods)]
-    assert 0 in methods
-    self.connection.sendall(struct.pack("!BB", SOCKS_VERSION, 0))
-
-    version, cmd, _, address_type = struct.unpack("!BBBB", self.connection.recv(4))
-    assert version == SOCKS_VERSION
-    assert cmd == 1 # Only allow connect
-
-    if address_type == 1:  # ipv4
-      rawaddr = self.connection.recv(4)
-      self.remote_address = socket.inet_ntop(socket.AF_INET, rawaddr)
-    elif address_type == 4:  # ipv6
-      rawaddr = self.connection.recv(16)
-      self.remote_address = socket.inet_ntop(socket.AF_INET6, rawaddr)
-      self.remote_family = socket.AF_INET6
-    elif address_type == 3:  # domain
-      rawaddr = self.connection.recv(1)
-      domain_length = ord(rawaddr)
-      self.remote_address = self.connection.recv(domain_length)
-      rawaddr = rawaddr + self.remote_address
-      self.remote_address = self.remote_address.decode()
-    else:
-      raise Exception("Unsupported socks address type")
-    self.remote_port = struct.unpack('!H', self.connection.recv(2))[0]
+    try:
+      with metrics.Timer('mitm_socks_handshake_seconds'):
+        address_type, rawaddr = self.read_socks_request()
+    except EOFError:
+      self.logger.info(f'Connection closed during socks handshake')
+      return
 
     self.remote_domain = self.remote_address
     if address_type == 3: # domain
@@ -156,6 +449,12 @@ class SocksProxy(StreamRequestHandler):
 
     assert self.remote_address
 
+    if reject:
+      # general SOCKS server failure
+      self.connection.sendall(struct.pack("!BBBBIH", SOCKS_VERSION, 1, 0, 1, 0, 0))
+      self.logger.info(f'done')
+      return
+
     try:
       try:
         self.remote_connect()
@@ -178,38 +477,231 @@ class SocksProxy(StreamRequestHandler):
       self.logger.info(f'done')
 SocksProxy.id = 0
 
+def next_connection_id():
+  if connection_counter is None:
+    SocksProxy.id = SocksProxy.id + 1
+    return SocksProxy.id
+  with connection_counter.get_lock():
+    connection_counter.value += 1
+    return connection_counter.value
+
+
+# Per direction buffer for the relay, which only exists while there is data in it
+class RelayBuffer:
+  def __init__(self, data=None, size=None):
+    self.size = size or relay_buffer_size
+    self.buf = None
+    self.start = 0
+    self.end = 0
+    if data:
+      self.alloc(len(data))
+      self.buf[0:len(data)] = data
+      self.end = len(data)
+
+  def alloc(self, n=0):
+    self.buf = bytearray(max(self.size, n))
+    self.view = memoryview(self.buf)
+
+  def __len__(self):
+    return self.end - self.start
+
+  # Must only be called if the buffer is empty. Returns 0 on EOF
+  def fill(self, s):
+    if self.buf is None:
+      self.alloc()
+    try:
+      nbytes = s.recv_into(self.view)
+    except:
+      self.close()
+      raise
+    self.start = 0
+    self.end = nbytes
+    if not nbytes:
+      self.close()
+    return nbytes
+
+  # Once everything has been sent, the buffer is freed, so that idle connections don't keep it
+  def drain(self, s):
+    nbytes = s.send(self.view[self.start:self.end])
+    self.start += nbytes
+    if self.start == self.end:
+      self.close()
+    return nbytes
+
+  def close(self):
+    if self.buf is not None:
+      self.view.release()
+      self.buf = None
+
+
+# Moves data from one socket to another through a pipe, without it ever leaving the kernel. The pipe only exists while
+# there is data in it, idle connections don't need to keep two descriptors for it.
+class Splicer:
+  def __init__(self, size=None):
+    self.r = self.w = None
+    self.size = size or relay_buffer_size
+    self.pending = 0
+
+  def __len__(self):
+    return self.pending
+
+  def open(self):
+    self.r, self.w = os.pipe2(os.O_NONBLOCK | os.O_CLOEXEC)
+    try:
+      fcntl.fcntl(self.w, F_SETPIPE_SZ, self.size)
+    except OSError:
+      pass
+
+  # Returns 0 on EOF. Moves up to n bytes, or as much as fits into the pipe.
+  def fill(self, s, n=None):
+    if self.r is None:
+      self.open()
+    try:
+      nbytes = os.splice(s.fileno(), self.w, self.size if n is None else min(n, self.size), flags=os.SPLICE_F_MOVE | os.SPLICE_F_NONBLOCK)
+    except:
+      if not self.pending:
+        self.close()
+      raise
+    self.pending += nbytes
+    if not self.pending:
+      self.close()
+    return nbytes
+
+  def drain(self, s):
+    nbytes = os.splice(self.r, s.fileno(), self.pending, flags=os.SPLICE_F_MOVE | os.SPLICE_F_NONBLOCK)
+    self.pending -= nbytes
+    if not self.pending:
+      self.close()
+    return nbytes
+
+  def close(self):
+    if self.r is not None:
+      os.close(self.r)
+      os.close(self.w)
+      self.r = self.w = None
+
+
+# SSLSocket.shutdown() throws away the TLS session, after which recv() would return the raw records. Peers also
+# consider the connection truncated if there was no close_notify.
+def shutdown_write(s):
+  try:
+    if isinstance(s, ssl.SSLSocket):
+      if s.gettimeout() == 0: # Otherwise, unwrap would wait for the close_notify of the peer
+        try:
+          s.unwrap()
+        except ssl.SSLError: # Usually SSLWantReadError, since the peer didn't close its side yet
+          pass
+      socket.socket.shutdown(s, socket.SHUT_WR)
+    else:
+      s.shutdown(socket.SHUT_WR)
+  except OSError:
+    pass
+
+
+# The tls module may only get loaded when it's first used, so this tries to use it on a connected socket
+def ktls_supported():
+  global ktls_available
+  if ktls_available is None:
+    ktls_available = False
+    if OP_ENABLE_KTLS:
+      try:
+        with socket.create_server(('127.0.0.1', 0)) as server, socket.create_connection(server.getsockname()) as s:
+          s.setsockopt(socket.SOL_TCP, TCP_ULP, b'tls')
+        ktls_available = True
+      except OSError as e:
+        logging.warning(f'Kernel TLS is not available, continuing without it: {e}')
+    else:
+      logging.warning(f'Kernel TLS is not available with {ssl.OPENSSL_VERSION}, continuing without it')
+  return ktls_available
+
+
+# Lets OpenSSL hand the record encryption over to the kernel after the handshake, if it can
+def enable_ktls(context):
+  if ktls_supported():
+    context.options |= OP_ENABLE_KTLS
+
+
+# Whether the kernel encrypts what's written to the socket
+def ktls_tx(s):
+  if not ktls_available or not isinstance(s, ssl.SSLSocket):
+    return False
+  try:
+    s.getsockopt(SOL_TLS, TLS_TX, 4) # Only the version & cipher, not the keys
+    return True
+  except OSError:
+    return False
+
+
+def is_plain(s):
+  return isinstance(s, socket.socket) and not isinstance(s, ssl.SSLSocket)
+
+
+# Data can be spliced from plain sockets to plain sockets, or to SSL sockets where the kernel does the encryption.
+# Reading stays with OpenSSL, it has to handle the non application data records.
+def can_splice(src, dst):
+  return use_splice and is_plain(src) and (is_plain(dst) or ktls_tx(dst))
+
+
+# Like select.select without the exceptional conditions, but using poll, which handles descriptors beyond FD_SETSIZE
+def select_sockets(rsl, wsl, timeout=None):
+  poller = select.poll()
+  fds = {}
+  for s in {*rsl, *wsl}:
+    fd = s.fileno()
+    fds[fd] = s
+    poller.register(fd, (select.POLLIN if s in rsl else 0) | (select.POLLOUT if s in wsl else 0))
+  ready = poller.poll(None if timeout is None else timeout * 1000)
+  # Errors & hangups show up as whatever was waited for, like with select
+  rs = [fds[fd] for fd, events in ready if fds[fd] in rsl and events & (select.POLLIN | select.POLLERR | select.POLLHUP)]
+  ws = [fds[fd] for fd, events in ready if fds[fd] in wsl and events & (select.POLLOUT | select.POLLERR | select.POLLHUP)]
+  return rs, ws
+
 
 def pipe_sockets(sa, sb, b2a_buf=None, a2b_buf=None, logprefix='', logger=logging):
   logger.info(f"{logprefix}pipe_sockets started")
+  a2b_buf = RelayBuffer(a2b_buf)
+  b2a_buf = RelayBuffer(b2a_buf)
+  c = metrics.counters()
+  c['mitm_relays_active'] += 1
   try:
     sa.setblocking(False)
     sb.setblocking(False)
     a2b = True
     b2a = True
-    if a2b_buf is None:
-      a2b_buf = b''
-    if b2a_buf is None:
-      b2a_buf = b''
+    splice_a2b = can_splice(sa, sb)
+    splice_b2a = can_splice(sb, sa)
     while a2b or b2a:
+      # Once the initial data has been sent, let the kernel do the rest
+      if splice_a2b and len(a2b_buf) == 0:
+        logger.info(f"{logprefix}pipe_sockets using splice for sa -> sb")
+        splice_a2b = False
+        a2b_buf.close()
+        a2b_buf = Splicer()
+      if splice_b2a and len(b2a_buf) == 0:
+        logger.info(f"{logprefix}pipe_sockets using splice for sb -> sa")
+        splice_b2a = False
+        b2a_buf.close()
+        b2a_buf = Splicer()
       rsl = set()
       if a2b and len(a2b_buf) == 0: rsl.add(sa)
       if b2a and len(b2a_buf) == 0: rsl.add(sb)
       wsl = set()
       if len(a2b_buf) != 0: wsl.add(sb)
       if len(b2a_buf) != 0: wsl.add(sa)
+      # TLS connections terminated in memory may have encrypted data left over from an earlier send
+      if hasattr(sa, 'send_pending') and sa.send_pending(): wsl.add(sa)
+      if hasattr(sb, 'send_pending') and sb.send_pending(): wsl.add(sb)
       pending = set()
       if hasattr(sa, 'pending') and sa in rsl and sa.pending():
         pending.add(sa)
       if hasattr(sb, 'pending') and sb in rsl and sb.pending():
         pending.add(sb)
-      rs, ws, es = select.select(rsl, wsl, [], 0 if len(pending) != 0 else None)
+      rs, ws = select_sockets(rsl, wsl, 0 if len(pending) != 0 else None)
       rs = {*rs, *pending}
       ws = {*ws}
-      if len(es):
-        break
       if sa in rs:
         try:
-          a2b_buf = sa.recv(16 * 4096)
+          nbytes = a2b_buf.fill(sa)
         except ssl.SSLWantReadError: pass
         except ssl.SSLWantWriteError: pass
         except OSError as e:
@@ -218,16 +710,14 @@ def pipe_sockets(sa, sb, b2a_buf=None, a2b_buf=None, logprefix='', logger=loggin
             raise
           logger.info(f"{logprefix}pipe_sockets sa -> sb expected data, but there was none")
         else:
-          if len(a2b_buf) == 0:
+          c[BYTES_DOWN] += nbytes
+          if nbytes == 0:
             a2b = False
             logger.info(f"{logprefix}pipe_sockets sa -> sb EOF")
-            try:
-              sb.shutdown(socket.SHUT_WR)
-            except OSError as error:
-              pass
+            shutdown_write(sb)
       if sb in rs:
         try:
-          b2a_buf = sb.recv(16 * 4096)
+          nbytes = b2a_buf.fill(sb)
         except ssl.SSLWantReadError: pass
         except ssl.SSLWantWriteError: pass
         except OSError as e:
@@ -236,39 +726,37 @@ def pipe_sockets(sa, sb, b2a_buf=None, a2b_buf=None, logprefix='', logger=loggin
             raise
           logger.info(f"{logprefix}pipe_sockets sb -> sa expected data, but there was none")
         else:
-          if len(b2a_buf) == 0:
+          c[BYTES_UP] += nbytes
+          if nbytes == 0:
             b2a = False
             logger.info(f"{logprefix}pipe_sockets sb -> sa EOF")
-            try:
-              sa.shutdown(socket.SHUT_WR)
-            except OSError as error:
-              pass
+            shutdown_write(sa)
+      for s in ws:
+        if hasattr(s, 'send_pending'):
+          s.send_some()
       if len(a2b_buf) != 0 and sb in ws:
         try:
-          nbytes = sb.send(a2b_buf)
+          a2b_buf.drain(sb)
         except ssl.SSLWantReadError: pass
         except ssl.SSLWantWriteError: pass
         except OSError as e:
           no = e.args[0]
           if no != errno.EAGAIN and no != errno.EWOULDBLOCK:
             raise
-        else:
-          if nbytes > 0:
-            a2b_buf = a2b_buf[nbytes:]
       if len(b2a_buf) != 0 and sa in ws:
         try:
-          nbytes = sa.send(b2a_buf)
+          b2a_buf.drain(sa)
         except ssl.SSLWantReadError: pass
         except ssl.SSLWantWriteError: pass
         except OSError as e:
           no = e.args[0]
           if no != errno.EAGAIN and no != errno.EWOULDBLOCK:
             raise
-        else:
-          if nbytes > 0:
-            b2a_buf = b2a_buf[nbytes:]
   #except OSError as e: pass
   finally:
+    c['mitm_relays_active'] -= 1
+    a2b_buf.close()
+    b2a_buf.close()
     try:
       sa.close()
     except: pass
@@ -278,16 +766,330 @@ def pipe_sockets(sa, sb, b2a_buf=None, a2b_buf=None, logprefix='', logger=loggin
     logger.info(f"{logprefix}pipe_sockets done")
 
 
+class RelayPipe:
+  def __init__(self, R, sa, sb, b2a_buf, a2b_buf, logprefix, logger):
+    self.R = R
+    self.loop = R.loop
+    self.sa = sa
+    self.sb = sb
+    self.a2b = True
+    self.b2a = True
+    self.a2b_buf = RelayBuffer(a2b_buf)
+    self.b2a_buf = RelayBuffer(b2a_buf)
+    self.logprefix = logprefix
+    self.logger = logger
+    self.readers = set()
+    self.writers = set()
+    self.closed = False
+    self.splice_a2b = can_splice(sa, sb)
+    self.splice_b2a = can_splice(sb, sa)
+
+  def start(self):
+    self.counters = metrics.counters()
+    self.counters['mitm_relays_active'] += 1
+    try:
+      self.sa.setblocking(False)
+      self.sb.setblocking(False)
+      self.update()
+    except:
+      self.fail()
+
+  def update(self):
+    if self.closed:
+      return
+    if not self.a2b and not self.b2a:
+      return self.close()
+    # Once the initial data has been sent, let the kernel do the rest
+    if self.splice_a2b and len(self.a2b_buf) == 0:
+      self.logger.info(f"{self.logprefix}pipe_sockets using splice for sa -> sb")
+      self.splice_a2b = False
+      self.a2b_buf.close()
+      self.a2b_buf = Splicer()
+    if self.splice_b2a and len(self.b2a_buf) == 0:
+      self.logger.info(f"{self.logprefix}pipe_sockets using splice for sb -> sa")
+      self.splice_b2a = False
+      self.b2a_buf.close()
+      self.b2a_buf = Splicer()
+    rsl = set()
+    if self.a2b and len(self.a2b_buf) == 0: rsl.add(self.sa)
+    if self.b2a and len(self.b2a_buf) == 0: rsl.add(self.sb)
+    wsl = set()
+    if len(self.a2b_buf) != 0: wsl.add(self.sb)
+    if len(self.b2a_buf) != 0: wsl.add(self.sa)
+    for s in rsl - self.readers:
+      self.loop.add_reader(s, self.on_readable, s)
+    for s in self.readers - rsl:
+      self.loop.remove_reader(s)
+    for s in wsl - self.writers:
+      self.loop.add_writer(s, self.on_writable, s)
+    for s in self.writers - wsl:
+      self.loop.remove_writer(s)
+    self.readers = rsl
+    self.writers = wsl
+    # An SSL socket may already have decrypted data buffered, the fd won't become readable for that
+    for s in rsl:
+      if hasattr(s, 'pending') and s.pending():
+        self.loop.call_soon(self.on_readable, s)
+
+  def on_readable(self, s):
+    if self.closed or s not in self.readers:
+      return
+    try:
+      self.recv(s)
+      self.update()
+    except:
+      self.fail()
+
+  def on_writable(self, s):
+    if self.closed or s not in self.writers:
+      return
+    try:
+      self.send(s)
+      self.update()
+    except:
+      self.fail()
+
+  def recv(self, s):
+    if s is self.sa:
+      name, other, buf, counter = 'sa -> sb', self.sb, self.a2b_buf, BYTES_DOWN
+    else:
+      name, other, buf, counter = 'sb -> sa', self.sa, self.b2a_buf, BYTES_UP
+    try:
+      nbytes = buf.fill(s)
+    except ssl.SSLWantReadError: return
+    except ssl.SSLWantWriteError: return
+    except OSError as e:
+      no = e.args[0]
+      if no != errno.EAGAIN and no != errno.EWOULDBLOCK:
+        raise
+      self.logger.info(f"{self.logprefix}pipe_sockets {name} expected data, but there was none")
+      return
+    self.counters[counter] += nbytes
+    if nbytes == 0:
+      if s is self.sa:
+        self.a2b = False
+      else:
+        self.b2a = False
+      self.logger.info(f"{self.logprefix}pipe_sockets {name} EOF")
+      shutdown_write(other)
+      return
+    # Most of the time, the other side can take the data right away
+    self.send(other)
+
+  def send(self, s):
+    buf = self.a2b_buf if s is self.sb else self.b2a_buf
+    try:
+      buf.drain(s)
+    except ssl.SSLWantReadError: return
+    except ssl.SSLWantWriteError: return
+    except OSError as e:
+      no = e.args[0]
+      if no != errno.EAGAIN and no != errno.EWOULDBLOCK:
+        raise
+      return
+
+  def fail(self):
+    self.logger.exception(f"{self.logprefix}pipe_sockets failed")
+    # If an error occured, reset the conections instead of just closing them
+    for s in (self.sa, self.sb):
+      try:
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack('ii', 1, 0))
+      except: pass
+    self.close()
+
+  def close(self):
+    if self.closed:
+      return
+    self.closed = True
+    self.counters['mitm_relays_active'] -= 1
+    for s in self.readers:
+      self.loop.remove_reader(s)
+    for s in self.writers:
+      self.loop.remove_writer(s)
+    self.readers = set()
+    self.writers = set()
+    self.a2b_buf.close()
+    self.b2a_buf.close()
+    for s in (self.sa, self.sb):
+      try:
+        s.close()
+      except: pass
+      self.R.sockets.discard(s)
+      callback = self.R.closers.pop(s, None)
+      if callback:
+        callback()
+    self.logger.info(f"{self.logprefix}pipe_sockets done")
+
+
+class RelayLoop:
+  def __init__(self):
+    self.sockets = set()
+    self.closers = {}
+    self.loop = asyncio.new_event_loop()
+    self.thread = threading.Thread(target=self.run, name='relay', daemon=True)
+    self.thread.start()
+
+  def run(self):
+    asyncio.set_event_loop(self.loop)
+    self.loop.run_forever()
+
+  def owns(self, s):
+    return s in self.sockets
+
+  def when_closed(self, s, callback):
+    def check():
+      if s in self.sockets:
+        self.closers[s] = callback
+      else:
+        callback()
+    self.loop.call_soon_threadsafe(check)
+
+  def pipe(self, sa, sb, b2a_buf=None, a2b_buf=None, logprefix='', logger=logging):
+    logger.info(f"{logprefix}pipe_sockets started")
+    self.sockets.add(sa)
+    self.sockets.add(sb)
+    P = RelayPipe(self, sa, sb, b2a_buf, a2b_buf, logprefix, logger)
+    self.loop.call_soon_threadsafe(P.start)
+    return P
+
+
+# Like pipe_sockets, but if the relay loop is enabled, the sockets are handed over to it, and this returns immediately.
+# The caller must not close sa or sb afterwards.
+def relay_sockets(sa, sb, b2a_buf=None, a2b_buf=None, logprefix='', logger=logging):
+  if not relay_loop:
+    return pipe_sockets(sa, sb, b2a_buf, a2b_buf, logprefix=logprefix, logger=logger)
+  relay_loop.pipe(sa, sb, b2a_buf, a2b_buf, logprefix=logprefix, logger=logger)
+
+
+def metrics_address(s):
+  if s.startswith('unix:'):
+    return s[5:]
+  return str2ipport('127.0.0.1', None, False)(s)
+
+
+def add_server_arguments(parser):
+  parser.add_argument('--event-loop', action='store_true', help='relay established connections on a single shared event loop instead of using a thread per connection')
+  parser.add_argument('--no-splice', action='store_true', help="don't use splice() for relaying data between plain sockets")
+  parser.add_argument('--buffer-size', type=int, default=relay_buffer_size, help='size of the buffer for each direction of a relayed connection')
+  parser.add_argument('--max-handlers', type=int, default=0, help='maximum number of connections being handled concurrently, 0 for unlimited')
+  parser.add_argument('--max-queued', type=int, default=0, help='maximum number of accepted connections waiting for a free handler')
+  parser.add_argument('--max-per-client', type=int, default=0, help='maximum number of concurrent connections per client IP, 0 for unlimited')
+  parser.add_argument('--workers', type=int, default=0, help='number of worker processes listening on the same address using SO_REUSEPORT, 0 for none')
+  parser.add_argument('--via-pool', type=int, default=0, help='number of connections to keep open to each socks proxy used for --via, ready for the connect request')
+  parser.add_argument('--via-pool-idle', type=float, default=30, help='seconds after which unused connections in the --via-pool are closed')
+  parser.add_argument('--dns-ttl', type=float, default=dns_cache.ttl, help='seconds to cache the addresses of domains connected to directly, 0 to disable the cache')
+  parser.add_argument('--dns-negative-ttl', type=float, default=dns_cache.negative_ttl, help='seconds to cache failed lookups')
+  parser.add_argument('--connect-timeout', type=float, default=dns_cache.connect_timeout, help='seconds after which connecting to a domain directly fails, if none of its addresses answered')
+  parser.add_argument('--metrics', type=metrics_address, help='IP:PORT or unix:PATH to serve metrics on, in prometheus format under /metrics and as JSON under /metrics.json')
+
+
+def run_server(args, RequestHandlerClass, reuse_port=False, worker=None):
+  global relay_loop
+  if args.event_loop:
+    relay_loop = RelayLoop()
+  with ThreadingTCPServer(args.listen, RequestHandlerClass, max_handlers=args.max_handlers, max_queued=args.max_queued, max_per_client=args.max_per_client, reuse_port=reuse_port) as server:
+    if args.metrics:
+      address = args.metrics
+      # Every worker has its own metrics
+      if worker is not None:
+        address = address + f'.{worker}' if isinstance(address, str) else (address[0], address[1] + worker)
+      metrics.collectors.append(lambda: {metrics.series('mitm_server_connections', state=k): v for k, v in server.counters().items()})
+      metrics.start_server(address)
+    server.serve_forever()
+
+
+def supervise(args, RequestHandlerClass):
+  global connection_counter
+  connection_counter = multiprocessing.Value('Q', 0)
+  workers = {}
+  quit = False
+  old_sighup = signal.getsignal(signal.SIGHUP)
+
+  def spawn(i):
+    pid = os.fork()
+    if pid == 0:
+      signal.signal(signal.SIGHUP, old_sighup)
+      signal.signal(signal.SIGTERM, signal.SIG_DFL)
+      signal.signal(signal.SIGINT, signal.SIG_DFL)
+      code = 0
+      try:
+        run_server(args, RequestHandlerClass, reuse_port=True, worker=i)
+      except:
+        traceback.print_exc()
+        code = 1
+      finally:
+        os._exit(code)
+    logging.info(f'Started worker {i} with pid {pid}')
+    workers[pid] = (i, time.monotonic())
+
+  def forward(signum, frame):
+    for pid in workers:
+      try:
+        os.kill(pid, signum)
+      except OSError: pass
+
+  def stop(signum, frame):
+    nonlocal quit
+    quit = True
+    forward(signal.SIGTERM, frame)
+
+  # If the address can't be bound, the workers would die right away and get restarted forever. Binding doesn't make the
+  # socket get any connections, only listening does.
+  server = ThreadingTCPServer(args.listen, RequestHandlerClass, bind_and_activate=False, reuse_port=True)
+  try:
+    server.server_bind()
+  finally:
+    server.server_close()
+
+  signal.signal(signal.SIGHUP, forward)
+  signal.signal(signal.SIGTERM, stop)
+  signal.signal(signal.SIGINT, stop)
+  for i in range(args.workers):
+    spawn(i)
+  while workers:
+    try:
+      pid, status = os.wait()
+    except ChildProcessError:
+      break
+    if pid not in workers:
+      continue
+    i, started = workers.pop(pid)
+    if quit:
+      continue
+    logging.warning(f'Worker {i} with pid {pid} exited with status {status}, restarting it')
+    # Don't restart workers in a tight loop if they die right away, for example because the address is in use
+    if time.monotonic() - started < 1:
+      time.sleep(1)
+    if not quit:
+      spawn(i)
+
+
+def serve(args, RequestHandlerClass):
+  global use_splice, relay_buffer_size, via_pool_size, via_pool_idle
+  if args.no_splice:
+    use_splice = False
+  relay_buffer_size = args.buffer_size
+  via_pool_size = args.via_pool
+  via_pool_idle = args.via_pool_idle
+  dns_cache.ttl = args.dns_ttl
+  dns_cache.negative_ttl = args.dns_negative_ttl
+  dns_cache.connect_timeout = args.connect_timeout
+  if args.workers:
+    supervise(args, RequestHandlerClass)
+  else:
+    run_server(args, RequestHandlerClass)
+
+
 class Transparent(SocksProxy):
   def remote_connect(self):
     self.logger.info(f'{self.id}: Connecting to remote {self.remote_address} :{self.remote_port}')
     s = self.mksocket(args.via)
-    self.rconnect(s, args.via)
-    self.sdirect = s
+    self.sdirect = self.rconnect(s, args.via)
 
   def handle_socks(self):
     self.logger.info(f'{self.id}: Socks5 connection established')
-    pipe_sockets(self.sdirect, self.connection, logger=self.logger)
+    relay_sockets(self.sdirect, self.connection, self.initial_data, logger=self.logger)
+    self.sdirect = None
 
   def cleanup(self):
     if self.sdirect:
@@ -300,6 +1102,6 @@ if __name__ == '__main__':
   parser = argparse.ArgumentParser(description='socks plain to tls proxy', formatter_class=argparse.ArgumentDefaultsHelpFormatter)
   parser.add_argument('-l', '--listen', type=str2ipport('127.0.0.1', 2666, False), help='IP:PORT to listen on', default='127.0.0.1:2666')
   parser.add_argument('-c', '--via', type=str2ipport(), help='IP:PORT of socks proxy to connect to, or "direct" for none', default='direct')
+  add_server_arguments(parser)
   args = parser.parse_args()
-  with ThreadingTCPServer(args.listen, Transparent) as server:
-    server.serve_forever()
+  serve(args, Transparent)
@@ -1,12 +1,18 @@
 #!/usr/bin/env python3
 
+import os, time, errno, signal, calendar, hashlib
 import logging
 import argparse
+import metrics
+import clienthello
 import socket, struct, random
-import ssl, threading, socks, ctypes
-from socksproxy import SocksProxy, ThreadingTCPServer, pipe_sockets, str2ipport, setprocname
-from tempfile import TemporaryFile
+import ssl, threading, socks, ctypes, multiprocessing, collections, queue
+from socksproxy import SocksProxy, ThreadingTCPServer, pipe_sockets, relay_sockets, select_sockets, str2ipport, setprocname, add_server_arguments, serve, enable_ktls, ktls_supported
+from tempfile import TemporaryFile, NamedTemporaryFile
 from OpenSSL import crypto
+from cryptography.hazmat.primitives.asymmetric import ec
+from resolver import is_address
+from singleflight import Pending
 from contextlib import contextmanager
 from socketserver import ThreadingMixIn, TCPServer
 
@@ -16,201 +22,466 @@ def readfile(file):
     return f.read()
 
 
+CERT_VALIDITY = 7*24*60*60
+CERT_RENEW_BEFORE = 24*60*60 # Forge a new certificate if the old one expires in less than that
+
+
 class Cert:
   def __init__(self, cert, key):
-    self.ref = 1
     self.cert = cert
     self.key = key
+    self.expires = calendar.timegm(time.strptime(cert.get_notAfter().decode(), '%Y%m%d%H%M%SZ'))
     with TemporaryFile(mode='w+b') as chain_file:
       chain_file.write(crypto.dump_privatekey(crypto.FILETYPE_PEM, key))
       chain_file.write(crypto.dump_certificate(crypto.FILETYPE_PEM, cert))
       chain_file.flush()
       chain_fd_path = '/proc/self/fd/'+str(chain_file.fileno())
       context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
-      context.load_verify_locations(CA.ca_cert_path);
       context.load_cert_chain(chain_fd_path)
       self.context = context
 
+  @staticmethod
+  def load(pem):
+    return Cert(crypto.load_certificate(crypto.FILETYPE_PEM, pem), crypto.load_privatekey(crypto.FILETYPE_PEM, pem))
+
+  def dump(self):
+    return crypto.dump_privatekey(crypto.FILETYPE_PEM, self.key) + crypto.dump_certificate(crypto.FILETYPE_PEM, self.cert)
+
+  def fresh(self):
+    return self.expires - time.time() > CERT_RENEW_BEFORE
+
+
+def generate_key(key_type):
+  if key_type == 'ecdsa':
+    return crypto.PKey.from_cryptography_key(ec.generate_private_key(ec.SECP256R1()))
+  key = crypto.PKey()
+  key.generate_key(crypto.TYPE_RSA, 2048)
+  return key
+
+
+# Runs in its own process, so it doesn't compete with the connections for the GIL. put blocks while the pool is full.
+def generate_keys(keys, key_type, parent):
+  setprocname('untls-keygen')
+  ctypes.CDLL(None).prctl(1, signal.SIGKILL, 0, 0, 0) # PR_SET_PDEATHSIG, don't outlive the proxy
+  if os.getppid() != parent:
+    return
+  try:
+    while True:
+      keys.put(crypto.dump_privatekey(crypto.FILETYPE_PEM, generate_key(key_type)))
+  except KeyboardInterrupt:
+    pass
+
+
+# Without the public suffix list, this can only guess where the registrable domain starts. Names directly below a
+# TLD, or below something like co.uk, get a certificate of their own, everything else one for *.parent
+def wildcard(name):
+  labels = name.split('.')
+  if len(labels) < 3 or '*' in name or is_address(name):
+    return name
+  if len(labels) == 3 and len(labels[-1]) == 2 and len(labels[-2]) <= 3:
+    return name
+  return '*.' + '.'.join(labels[1:])
+
 
 class CertGen:
-  def __init__(self, ca_cert, ca_key):
-    self.certs = {}
+  def __init__(self, ca_cert, ca_key, shared=False, store=None, cache_size=1024, key_type='rsa', key_pool=8, wildcards=False):
+    self.certs = collections.OrderedDict() # Least recently used first
+    self.issuing = {} # Certificates currently being forged, so concurrent connections to the same name wait for them
+    self.lock = threading.Lock()
+    self.cache_size = cache_size
+    self.key_type = key_type
+    # Pregenerated keys in PEM format, shared between worker processes
+    self.keys = None
+    if key_pool > 0:
+      self.keys = multiprocessing.Queue(key_pool)
+      multiprocessing.Process(target=generate_keys, args=(self.keys, key_type, os.getpid()), daemon=True).start()
+    # Forged certificates in PEM format, shared between worker processes
+    self.shared = multiprocessing.Manager().dict() if shared else None
+    self.wildcards = wildcards
+    # All TLS connections start with this context, sni_callback then switches them to the one of the forged certificate.
+    # Session tickets & the session cache stay those of this context, so sessions can be resumed regardless of which
+    # certificate was used. It's created before the workers are forked, so they all share the same ticket keys.
+    self.context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    self.context.sni_callback = self.sni_callback
     self.ca_cert_path = ca_cert
     self.ca_cert = crypto.load_certificate(crypto.FILETYPE_PEM, readfile(ca_cert))
     self.ca_key = crypto.load_privatekey(crypto.FILETYPE_PEM, readfile(ca_key))
+    # Certificates on disk, in a directory per CA, so they can't get mixed up if the CA changes
+    self.store = None
+    if store:
+      self.store = os.path.join(store, self.ca_cert.digest('sha256').decode().replace(':', '').lower())
+      os.makedirs(self.store, mode=0o700, exist_ok=True)
+
+  def sni_callback(self, sslsock, server_name, context):
+    if not server_name:
+      return ssl.ALERT_DESCRIPTION_UNRECOGNIZED_NAME
+    with self.get(server_name) as c:
+      sslsock.context = c.context
 
   @contextmanager
   def get(self, name):
-    try:
-      ex = self.certs.get(name)
-      if ex:
-        ex.ref += 1
-        yield ex
+    if self.wildcards:
+      name = wildcard(name)
+    with self.lock:
+      c = self.certs.get(name)
+      if c and c.fresh():
+        self.certs.move_to_end(name)
+        issuance = None
       else:
-        key = crypto.PKey()
-        key.generate_key(crypto.TYPE_RSA, 2048)
+        issuance = self.issuing.get(name)
+        owner = issuance is None
+        if owner:
+          issuance = self.issuing[name] = Pending()
+    if issuance is None:
+      metrics.inc(metrics.series('mitm_cert_cache_total', result='hit'))
+    elif not owner:
+      metrics.inc(metrics.series('mitm_cert_cache_total', result='pending'))
+      c = issuance.wait()
+      if c is None:
+        raise RuntimeError(f'Forging a certificate for {name} failed')
+    else:
+      c = None
+      try:
+        c = self.issue(name)
+        with self.lock:
+          self.certs[name] = c
+          while len(self.certs) > self.cache_size:
+            self.certs.popitem(last=False)
+      finally:
+        with self.lock:
+          del self.issuing[name]
+        issuance.set(c)
+    yield c
+
+  def issue(self, name):
+    c = self.lookup(name)
+    if not c:
+      metrics.inc(metrics.series('mitm_cert_cache_total', result='miss'))
+      start = time.monotonic()
+      c = self.forge(name)
+      metrics.observe('mitm_cert_generation_seconds', time.monotonic() - start)
+      if self.shared is not None:
+        self.shared[name] = c.dump()
+      if self.store:
+        self.save(name, c)
+    return c
+
+  def new_key(self):
+    if self.keys is not None:
+      try:
+        return crypto.load_privatekey(crypto.FILETYPE_PEM, self.keys.get_nowait())
+      except queue.Empty:
+        metrics.inc('mitm_cert_key_pool_empty_total')
+    return generate_key(self.key_type)
+
+  # Certificates forged by other processes
+  def lookup(self, name):
+    if self.shared is not None:
+      pem = self.shared.get(name)
+      if pem:
+        c = Cert.load(pem)
+        if c.fresh():
+          metrics.inc(metrics.series('mitm_cert_cache_total', result='shared'))
+          return c
+    if self.store:
+      try:
+        pem = readfile(self.path(name)).encode()
+      except FileNotFoundError:
+        return None
+      try:
+        c = Cert.load(pem)
+      except crypto.Error:
+        logging.warning(f'Ignoring broken certificate for {name} in {self.path(name)}')
+        return None
+      if c.fresh():
+        metrics.inc(metrics.series('mitm_cert_cache_total', result='store'))
+        return c
+    return None
 
-        cert = crypto.X509()
-        cert.set_version(2)
-        cert.set_serial_number(random.randint(50000000,100000000))
+  def path(self, name):
+    return os.path.join(self.store, hashlib.sha256(name.encode()).hexdigest() + '.pem')
 
-        cert.get_subject().commonName = name
+  def save(self, name, c):
+    # Other processes may be reading it at the same time, so the file is replaced atomically
+    with NamedTemporaryFile(dir=self.store, suffix='.tmp', delete=False) as f:
+      f.write(c.dump())
+    os.replace(f.name, self.path(name))
 
-        cert.add_extensions([
-          crypto.X509Extension(b"basicConstraints", False, b"CA:FALSE"),
-          crypto.X509Extension(b"subjectKeyIdentifier", False, b"hash", subject=cert),
-          crypto.X509Extension(b"subjectAltName", False, ("DNS:"+name).encode('utf-8')),
-        ])
+  def forge(self, name):
+    key = self.new_key()
 
-        cert.add_extensions([
-          crypto.X509Extension(b"authorityKeyIdentifier", False, b"keyid:always", issuer=self.ca_cert),
-          crypto.X509Extension(b"extendedKeyUsage", False, b"serverAuth"),
-          crypto.X509Extension(b"keyUsage", False, b"digitalSignature, keyEncipherment"),
-        ])
+    cert = crypto.X509()
+    cert.set_version(2)
+    cert.set_serial_number(random.randint(50000000,100000000))
 
-        cert.set_issuer(self.ca_cert.get_subject())
-        cert.set_pubkey(key)
+    cert.get_subject().commonName = name
 
-        cert.gmtime_adj_notBefore(-24*60*60)
-        cert.gmtime_adj_notAfter(7*24*60*60)
+    cert.add_extensions([
+      crypto.X509Extension(b"basicConstraints", False, b"CA:FALSE"),
+      crypto.X509Extension(b"subjectKeyIdentifier", False, b"hash", subject=cert),
+      crypto.X509Extension(b"subjectAltName", False, ("DNS:"+name).encode('utf-8')),
+    ])
 
-        cert.sign(self.ca_key, 'sha256')
+    cert.add_extensions([
+      crypto.X509Extension(b"authorityKeyIdentifier", False, b"keyid:always", issuer=self.ca_cert),
+      crypto.X509Extension(b"extendedKeyUsage", False, b"serverAuth"),
+      crypto.X509Extension(b"keyUsage", False, b"digitalSignature, keyEncipherment" if key.type() == crypto.TYPE_RSA else b"digitalSignature"),
+    ])
 
-        c = Cert(cert, key)
-        self.certs[name] = c
-        yield c
-    finally:
-      ex = self.certs[name]
-      ex.ref -= 1
-      # TODO: Add the below to a timer, and add an expiry date check
-      #if ex.ref <= 0:
-      #  del self.certs[name]
+    cert.set_issuer(self.ca_cert.get_subject())
+    cert.set_pubkey(key)
 
+    cert.gmtime_adj_notBefore(-24*60*60)
+    cert.gmtime_adj_notAfter(CERT_VALIDITY)
 
-def kill_thread(thread):
-    thread_id = thread.ident
-    res = ctypes.pythonapi.PyThreadState_SetAsyncExc(thread_id, ctypes.py_object(SystemExit))
-    if res > 1:
-      ctypes.pythonapi.PyThreadState_SetAsyncExc(thread_id, 0)
-      logging.error('Exception raise failure')
+    cert.sign(self.ca_key, 'sha256')
 
+    return Cert(cert, key)
 
-class TLSStripper(SocksProxy):
-  data = b''
 
-  def crecv(self, l):
-    assert len(self.data) + l < 1024 * 10 # Arbitrary limit, if we have to read more than 10K, something's probably off
-    res = self.connection.recv(l)
-    self.data += res
-    return res
+def add_cert_arguments(parser):
+  parser.add_argument('--ca', default="/etc/ssl/CA/CA.pem")
+  parser.add_argument('--ca-key', default="/etc/ssl/CA/CA.key")
+  parser.add_argument('--cert-store', help='directory to keep the forged certificates in, so they survive restarts and can be shared with other processes')
+  parser.add_argument('--cert-cache-size', type=int, default=1024, help='maximum number of forged certificates to keep in memory')
+  parser.add_argument('--cert-key-type', choices=['rsa', 'ecdsa'], default='rsa', help='type of the keys of forged certificates, rsa is 2048 bit, ecdsa uses P-256')
+  parser.add_argument('--cert-wildcards', action='store_true', help='forge one wildcard certificate for all subdomains of a domain, instead of one per name')
+  parser.add_argument('--cert-key-pool', type=int, default=8, help='number of keys to generate ahead of time in a background process, 0 to generate them when needed')
+
+
+def create_certgen(args):
+  return CertGen(args.ca, args.ca_key, shared=args.workers > 0, store=args.cert_store, cache_size=args.cert_cache_size, key_type=args.cert_key_type, key_pool=args.cert_key_pool, wildcards=args.cert_wildcards)
+
+
+# Terminates TLS on a socket using an SSLObject and memory BIOs, in the thread which uses it. Behaves enough like a
+# non-blocking SSLSocket for pipe_sockets and the interceptor: recv raises SSLWantReadError if there's no complete record
+# yet, and pending() tells if there is data to be read without the socket becoming readable. send_pending() tells if
+# there is encrypted data left to send once the socket becomes writable.
+class TLSConnection:
+  recv_size = 64 * 1024
+  max_incoming = 1024 * 1024
+
+  def __init__(self, sock, context, data=b''):
+    self.sock = sock
+    self.incoming = ssl.MemoryBIO()
+    self.outgoing = ssl.MemoryBIO()
+    self.unsent = b'' # Encrypted data the socket didn't take yet
+    if data:
+      self.incoming.write(data)
+    self.sslobj = context.wrap_bio(self.incoming, self.outgoing, server_side=True)
+
+  def __getattr__(self, name):
+    return getattr(self.sslobj, name)
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    self.close()
 
+  def fileno(self):
+    return self.sock.fileno()
+
+  def setblocking(self, flag):
+    self.sock.setblocking(flag)
+
+  def setsockopt(self, *args):
+    self.sock.setsockopt(*args)
+
+  # The socket must still be in blocking mode
+  def do_handshake(self):
+    while True:
+      try:
+        self.sslobj.do_handshake()
+        break
+      except ssl.SSLWantReadError:
+        self.flush()
+        self.fill()
+    self.flush()
+
+  # Returns False if there was nothing to read
+  def fill(self):
+    try:
+      data = self.sock.recv(self.recv_size)
+    except BlockingIOError:
+      return False
+    if data:
+      self.incoming.write(data)
+    else:
+      self.incoming.write_eof()
+    return True
+
+  # Sends as much of the encrypted data as the socket takes without blocking. Returns the number of bytes left.
+  def send_some(self):
+    if self.outgoing.pending:
+      self.unsent = bytes(self.unsent) + self.outgoing.read()
+    while self.unsent:
+      try:
+        nbytes = self.sock.send(self.unsent)
+      except BlockingIOError:
+        break
+      self.unsent = memoryview(self.unsent)[nbytes:]
+    return len(self.unsent)
+
+  def send_pending(self):
+    return len(self.unsent) + self.outgoing.pending
+
+  # Waits until all the encrypted data has been sent. Meanwhile, it keeps reading what the peer sends, so that it can't
+  # end up waiting for us to read while we wait for it. Only for the thread of the connection, see send.
+  def flush(self):
+    while self.send_some():
+      rs, ws = select_sockets([self.sock] if self.incoming.pending < self.max_incoming else [], [self.sock])
+      if rs:
+        self.fill()
+
+  def pending(self):
+    return self.sslobj.pending() or self.incoming.pending
+
+  def recv_into(self, buffer, nbytes=0):
+    while True:
+      try:
+        return self.sslobj.read(nbytes or len(buffer), buffer)
+      except ssl.SSLWantReadError:
+        if not self.fill():
+          raise
+      except ssl.SSLEOFError: # Like suppress_ragged_eofs
+        return 0
+      finally:
+        if self.outgoing.pending: # Post handshake messages
+          self.send_some()
+
+  def recv(self, n):
+    buffer = bytearray(n)
+    return bytes(buffer[:self.recv_into(buffer)])
+
+  # Doesn't block on a non-blocking socket, as it's also used on the shared event loop of the interceptors. Like a socket
+  # with a full buffer, it takes nothing while there is encrypted data left, which send_pending tells, and send_some or
+  # flush have to get rid of.
+  def send(self, data):
+    if self.send_some():
+      raise BlockingIOError(errno.EAGAIN, os.strerror(errno.EAGAIN))
+    try:
+      nbytes = self.sslobj.write(data)
+    except ssl.SSLEOFError: # The peer is gone, which would be EPIPE for a socket
+      raise BrokenPipeError(errno.EPIPE, os.strerror(errno.EPIPE)) from None
+    self.send_some()
+    return nbytes
+
+  def sendall(self, data):
+    self.flush()
+    self.send(data)
+    self.flush()
+
+  # Sends close_notify before shutting down the socket, otherwise the client sees a truncated connection
+  def shutdown(self, how):
+    if how != socket.SHUT_RD:
+      try:
+        self.sslobj.unwrap()
+      except ssl.SSLWantReadError: # It only sent close_notify so far, reading is still possible
+        pass
+      except ssl.SSLError:
+        pass
+      self.flush()
+    self.sock.shutdown(how)
+
+  def close(self):
+    self.sock.close()
+
+
+class TLSStripper(SocksProxy):
+  # Connecting before accepting the socks connection means connections to unreachable targets can be refused, but it
+  # costs a connection which is thrown away for everything that gets decrypted. Otherwise, it connects once it knows where to.
   def remote_connect(self):
     self.sdirect = None
+    if args.early_connect:
+      self.sdirect = self.plain_connect()
+
+  # For non-mitm-ed / direct connections
+  def plain_connect(self):
     logging.info(f'{self.id}: Connecting to remote {self.remote_address} :{self.remote_port}')
-    # Note: This is for non-mitm-ed / direct connections. We do this early, so we can refuse connections early too.
     s = self.mksocket(args.via)
-    self.rconnect(s, args.via)
-    self.sdirect = s
+    return self.rconnect(s, args.via)
 
   def handle_socks(self):
     logging.info(f'{self.id}: Socks5 connection established')
+    data = self.initial_data
+    self.initial_data = b''
+    # Kernel TLS needs OpenSSL to own the socket, so the ClientHello is only peeked at and left for it to read
+    peek = args.ktls and ktls_supported() and not data
     try:
-
-      # TLSPlaintext
-      ptype = ord(self.crecv(1))
-      assert ptype == 22 # TLSPlaintext::type == ContentType::handshake
-      struct.unpack("!H", self.crecv(2)) # TLSPlaintext::legacy_record_version. Per spec: field is deprecated and MUST be ignored for all purposes
-      plength, = struct.unpack("!H", self.crecv(2)) # TLSPlaintext::length. Only includes following bytes.
-      assert plength <= 2**24 # Per spec: The length MUST NOT exceed 2^14 bytes.
-      assert plength >= 54 # Impossible to be shorter
-
-      # Handshake
-      htype = ord(self.crecv(1))
-      assert htype == 1 # Handshake::type == HandshakeType::client_hello
-      hlength, = struct.unpack("!I", b'\0' + self.crecv(3)) # Handshake::length, remaining bytes in message
-      assert hlength <= plength-4 # Handshake::type and Handshake::length are 4 bytes, so Handshake data must be at least 4 bytes smaller than fragment data
-      assert hlength >= 50 # Impossible to be shorter
-
-      # ClientHello
-      vversion, = struct.unpack("!H", self.crecv(2))
-      assert vversion == 0x0303 # ClientHello::version == TLS v1.2. Should also cover newer versions, since this field was deprecated for better backwards compat
-      self.crecv(32) # ClientHello::random
-      sid_len = ord(self.crecv(1))
-      assert sid_len <= 32
-      hlength -= 35 + sid_len + 2
-      assert hlength >= 13 # Impossible to be shorter
-      if sid_len:
-        self.crecv(sid_len)
-      vsciphersuite_len, = struct.unpack("!H", self.crecv(2))
-      hlength -= vsciphersuite_len + 1
-      assert hlength >= 12 # Impossible to be shorter
-      if vsciphersuite_len:
-        self.crecv(vsciphersuite_len)
-      vcompression_method_len = ord(self.crecv(1))
-      hlength -= vcompression_method_len + 2
-      assert hlength >= 10 # Impossible to be shorter
-      if vcompression_method_len:
-        self.crecv(vcompression_method_len)
-
-      # Extensions, this is what we're looking for
-      ext_len, = struct.unpack("!H", self.crecv(2))
-      assert hlength >= ext_len # Impossible to be shorter
-      sni=b''
-      while ext_len > 0:
-        ext_len -= 4
-        assert ext_len >= 0
-        etype, elength = struct.unpack("!HH", self.crecv(4))
-        ext_len -= elength
-        assert ext_len >= 0 # Impossible to be shorter
-        buf = self.crecv(elength)
-        off = 0
-        if etype == 0: # Extension::type == ExtensionType::server_name
-          sllen, = struct.unpack("!H", buf[off:off+2])
-          off += 2
-          while sllen > 0:
-            stype = ord(buf[off:off+1])
-            off += 1
-            slen, = struct.unpack("!H", buf[off:off+2])
-            off += 2
-            if slen == 0:
-              continue
-            name = buf[off:off+slen]
-            off += slen
-            if stype == 0: # ServerName::name_type, 0 = host_name
-              sni = name
-              break
-            name = None
+      # Read as much as there is, until there is a complete ClientHello, or it's clear that this isn't one
+      while True:
+        hello = clienthello.parse(data)
+        if hello:
           break
-      assert sni
-      sni = sni.decode()
-
-    except:
-      logging.info(f'{self.id}: Couldn\'t extract SNI, assuming plain connection')
-      pipe_sockets(self.sdirect, self.connection, self.data, logprefix=f'{self.id}: client <=> remote: ')
-      self.data = None
+        if peek:
+          # Peeking returns what's already there right away, so wait until there's more than last time
+          self.connection.setsockopt(socket.SOL_SOCKET, socket.SO_RCVLOWAT, len(data) + 1)
+          res = self.connection.recv(len(data) + clienthello.RECV_SIZE, socket.MSG_PEEK)
+          if len(res) <= len(data):
+            raise ValueError('Connection closed before the end of the ClientHello')
+          data = res
+          continue
+        res = self.connection.recv(clienthello.RECV_SIZE)
+        if not res:
+          raise ValueError('Connection closed before the end of the ClientHello')
+        data += res
+      if not hello.sni:
+        raise ValueError('No SNI')
+    except (ValueError, OSError) as e:
+      logging.info(f'{self.id}: Couldn\'t extract SNI, assuming plain connection: {e}')
+      hello = None
+    if peek:
+      self.connection.setsockopt(socket.SOL_SOCKET, socket.SO_RCVLOWAT, 1)
+      data = b''
+
+    if hello is None:
+      self.relay_plain(data)
       return
 
-    logging.info(f'{self.id}: Got SNI: {sni}')
+    sni = hello.sni
+    logging.info(f'{self.id}: Got SNI: {sni}, ALPN: {",".join(hello.alpn)}')
 
-    self.sdirect.close()
+    if self.sdirect:
+      self.sdirect.close()
+      self.sdirect = None
+
+    if peek:
+      # wrap_socket detaches the socket it's given, self.connection is still needed afterwards
+      ssock = CA.context.wrap_socket(self.connection.dup(), server_side=True, do_handshake_on_connect=False)
+    else:
+      ssock = TLSConnection(self.connection, CA.context, data)
+    with ssock:
+      # The certificate is forged or looked up by CA.sni_callback during the handshake
+      with metrics.Timer('mitm_tls_handshake_seconds', side='server'):
+        ssock.do_handshake()
+      metrics.inc(metrics.series('mitm_tls_sessions_total', side='server', result='hit' if ssock.session_reused else 'miss'))
+      self.relay_decrypted(ssock, sni)
+
+  # Without --early-connect, the client was already told that the connection succeeded, all that's left is resetting it
+  def lazy_plain_connect(self):
+    if self.sdirect:
+      return True
+    try:
+      self.sdirect = self.plain_connect()
+      return True
+    except OSError as e:
+      logging.error(f'{self.id}: {e}')
+      self.connection.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack('ii', 1, 0))
+      return False
+
+  # Takes over self.sdirect
+  def relay_plain(self, data):
+    if not self.lazy_plain_connect():
+      return
+    relay_sockets(self.sdirect, self.connection, data, logprefix=f'{self.id}: client <=> remote: ')
+    self.sdirect = None
 
-    # Create certificate
-    with CA.get(sni) as crt:
-      sa, sb = socket.socketpair()
-      try:
-        t1 = threading.Thread(target=pipe_sockets, args=(sa, self.connection, self.data, None, f'{self.id}: client <=> mitm ssl in: '))
-        self.data = None
-        t1.daemon = True
-        t1.start()
-        with crt.context.wrap_socket(sb, server_side=True) as ssock:
-          s = self.mksocket(args.tls_via)
-          self.rconnect(s, args.via, sni)
-          pipe_sockets(s, ssock, logprefix=f'{self.id}: mitm decrypted out <=> remote: ')
-      finally:
-        sb.close()
-        if t1:
-          kill_thread(t1)
-        sa.close()
+  # Must not return before the connection is done, ssock gets closed afterwards
+  def relay_decrypted(self, ssock, sni):
+    s = self.mksocket(args.tls_via)
+    s = self.rconnect(s, args.tls_via, sni)
+    pipe_sockets(s, ssock, logprefix=f'{self.id}: mitm decrypted out <=> remote: ')
 
   def cleanup(self):
     if self.sdirect:
@@ -224,9 +495,13 @@ if __name__ == '__main__':
   parser.add_argument('-l', '--listen', type=str2ipport('0.0.0.0',1666, False), help='IP:PORT to listen on', default='0.0.0.0:1666')
   parser.add_argument('-c', '--via', type=str2ipport(), help='IP:PORT of socks proxy to connect to for undecryptable traffic, or "direct" for none', default='127.0.0.1:2666')
   parser.add_argument('-t', '--tls-via', type=str2ipport(), help='IP:PORT of socks proxy to connect to for decrypted traffic', default='127.0.0.1:3666')
-  parser.add_argument('--ca', default="/etc/ssl/CA/CA.pem")
-  parser.add_argument('--ca-key', default="/etc/ssl/CA/CA.key")
+  parser.add_argument('--early-connect', action='store_true', help='connect via --via before accepting the socks connection, to refuse connections to unreachable targets')
+  parser.add_argument('--ktls', action='store_true', help='let the kernel encrypt the traffic to the clients where possible, falls back to OpenSSL if it can\'t')
+  add_cert_arguments(parser)
+  add_server_arguments(parser)
   args = parser.parse_args()
-  CA = CertGen(args.ca, args.ca_key)
-  with ThreadingTCPServer(args.listen, TLSStripper) as server:
-    server.serve_forever()
+  CA = create_certgen(args)
+  if args.ktls:
+    # The options of the context the connection starts with stick, even after the SNI callback switches it
+    enable_ktls(CA.context)
+  serve(args, TLSStripper)